@@ -2,8 +2,10 @@ from boto.mturk.connection import MTurkConnection
 from boto.mturk.question import ExternalQuestion
 
 from django.utils import simplejson as json
+from itertools import groupby
 
 import settings
+from crowdforge import codec
 from crowdforge.models import *
 
 def create_hit(hit_type, problem, params={}):
@@ -132,11 +134,12 @@ def can_reduce(problem):
 
 def do_reduce(problem):
     assert can_reduce(problem)
-    # gets all of the map HITs
+    # gets all of the map HITs and all of their results, in one query each
     map_hits = Hit.objects.filter(problem=problem, hit_type=problem.mapper)
+    reduction_data = get_all_reduction_data(problem)
     for hit in map_hits:
         # for each map HIT, get all results for it
-        params = {'list': get_reduction_data(hit)}
+        params = {'list': reduction_data.get(hit.id, '')}
         params.update(json.loads(hit.part))
         
         # creates HITs for the reduction based on those results
@@ -163,13 +166,15 @@ def get_reduction_data(hit):
     # gets the payload for the reduce HIT.
     # we want it in an HTML list. <li>
     # reduce template: 
-    list_html = ''
-    results = hit.result_set.all()
-    for result in results:
-        value = json.loads(result.value)
-        list_html += '<li>%s</li>' % value['fact']
+    rows = hit.result_set.order_by('id').values_list('id', 'value_ref')
+    return ''.join(['<li>%s</li>' % codec.parse_result(id, value)['fact'] for id, value in rows])
     
-    return list_html
+def get_all_reduction_data(problem):
+    # gets the payloads for all reduce HITs of the problem, by map HIT id
+    results = Result.objects.filter(hit__problem=problem, hit__hit_type=problem.mapper) \
+        .order_by('hit', 'id').values_list('hit', 'id', 'value_ref').iterator()
+    return dict([(hit_id, ''.join(['<li>%s</li>' % codec.parse_result(id, value)['fact'] for hit, id, value in rows]))
+        for hit_id, rows in groupby(results, lambda row: row[0])])
     
 def get_partition(problem):
     partition = []
@@ -178,7 +183,7 @@ def get_partition(problem):
         results = Result.objects.filter(hit__hit_type=problem.partition, hit__problem=problem)
         # just use the first one for now
         first_result = results[0]
-        outline = json.loads(first_result.value).items()
+        outline = first_result.data.items()
         for item in sorted(outline):
             if item[1]:
                 partition.append([item[1]])
@@ -188,10 +193,10 @@ def get_partition(problem):
         col_headers = Result.objects.filter(hit__hit_type=problem.partition2, hit__problem=problem)
         # again, use the first of both for now
         first_row_header = row_headers[0]
-        row_labels = json.loads(first_row_header.value).items()
+        row_labels = first_row_header.data.items()
         
         first_col_header = col_headers[0]
-        col_labels = json.loads(first_col_header.value).items()
+        col_labels = first_col_header.data.items()
         for r in row_labels:
             for c in col_labels:
                 if r[1] and c[1]:
@@ -0,0 +1,102 @@
+"""
+Content-addressed store for large text payloads.
+
+Hit.body, Hit.params and Result.value can get big (a reduce HIT carries the
+whole output of its map HIT, twice), and keeping them inline makes every
+query on the hit and result tables drag them along. Values longer than
+BLOB_INLINE_LIMIT characters are written to a file under BLOB_ROOT named by
+the SHA-1 of their contents, and the database column holds only
+'blob:<sha1>'. Identical payloads are stored once.
+
+Models expose the payloads through BlobProperty, so code reads and writes
+hit.body as before; the raw column is the *_ref field, which is what
+defer() and values_list() see. Blobs are never deleted since any number of
+rows may refer to the same one.
+"""
+from django.utils.hashcompat import sha_constructor
+import os
+import uuid
+
+import settings
+
+PREFIX = 'blob:'
+
+def get_root():
+    return getattr(settings, 'BLOB_ROOT', None) or os.path.join(os.path.dirname(os.path.abspath(settings.__file__)), 'blobs')
+
+def get_path(key):
+    return os.path.join(get_root(), key[:2], key[2:])
+
+def put(text):
+    """Store the text and return its key"""
+    data = text.encode('utf-8')
+    key = sha_constructor(data).hexdigest()
+    path = get_path(key)
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        # write to a temporary file first so that readers never see half a
+        # blob; unlike mkstemp's, its mode follows the umask so that a web
+        # server running as another user can read it
+        tmp = os.path.join(directory, '.%s.%s' % (key[2:], uuid.uuid4().hex))
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tmp, path)
+    return key
+
+def get(key):
+    f = open(get_path(key), 'rb')
+    try:
+        return f.read().decode('utf-8')
+    finally:
+        f.close()
+
+def pack(text):
+    """The value to store in the database column for the text"""
+    if text is None:
+        return text
+    text = unicode(text)
+    # inline values must never look like a reference
+    if len(text) > getattr(settings, 'BLOB_INLINE_LIMIT', 1024) or text.startswith(PREFIX):
+        return PREFIX + put(text)
+    return text
+
+def unpack(value):
+    """The text for a database column value"""
+    if value and value.startswith(PREFIX):
+        return get(value[len(PREFIX):])
+    return value
+
+class BlobProperty(property):
+    """
+    Model attribute for a payload stored in the `ref` field. Loads the blob
+    the first time it's read and stores it when it's set. Subclasses property
+    so that it can be passed to the model's constructor.
+    """
+    def __init__(self, ref):
+        self.ref = ref
+        self.cache = '_%s_cache' % ref
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        stored = getattr(instance, self.ref)
+        cached = instance.__dict__.get(self.cache)
+        if cached is None or cached[0] is not stored:
+            cached = (stored, unpack(stored))
+            instance.__dict__[self.cache] = cached
+        return cached[1]
+
+    def __set__(self, instance, value):
+        stored = pack(value)
+        setattr(instance, self.ref, stored)
+        instance.__dict__[self.cache] = (stored, value)
@@ -0,0 +1,88 @@
+"""
+Parsing of Result values, with a cache of the parsed values.
+
+Flows read the same results over and over (the partition result at every
+stage, every map result of a problem when its reduce HITs are made), and
+each read used to parse the JSON again. Parsed values are kept in a per
+process LRU cache of RESULT_CACHE_SIZE entries keyed by Result id. An entry
+also remembers the raw column value it was parsed from, so a result whose
+value changed is parsed again rather than served stale.
+
+The JSON decoder is the loads (or decode, for cjson) function of the module
+named by JSON_CODEC, e.g. 'ujson' or 'cjson' if installed; the default is
+Django's simplejson. Values are always written with simplejson.
+
+Cached values are shared, so callers must not modify them.
+"""
+from django.utils.importlib import import_module
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+import settings
+from crowdforge.blobstore import unpack
+
+_decoder = None
+
+def get_decoder():
+    global _decoder
+    name = getattr(settings, 'JSON_CODEC', None) or 'django.utils.simplejson'
+    if _decoder is None or _decoder[0] != name:
+        module = import_module(name)
+        _decoder = (name, getattr(module, 'loads', None) or module.decode)
+    return _decoder[1]
+
+def loads(text):
+    return get_decoder()(text)
+
+class ValueCache(object):
+    """Thread-safe LRU cache of parsed values by id"""
+    def __init__(self, size=None):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get_size(self):
+        if self.size is not None:
+            return self.size
+        return getattr(settings, 'RESULT_CACHE_SIZE', 10000)
+
+    def parse(self, id, raw):
+        """The parsed value of `raw`, the stored (possibly blob:) column value of row `id`"""
+        if id is None or not self.get_size():
+            return loads(unpack(raw))
+        with self.lock:
+            entry = self.entries.pop(id, None)
+            if entry is not None and entry[0] == raw:
+                # move to the most recently used end
+                self.entries[id] = entry
+                self.hits += 1
+                return entry[1]
+        value = loads(unpack(raw))
+        with self.lock:
+            self.misses += 1
+            self.entries.pop(id, None)
+            self.entries[id] = (raw, value)
+            while len(self.entries) > self.get_size():
+                del self.entries[iter(self.entries).next()]
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+# Result id: (raw value, parsed value)
+results = ValueCache()
+
+def parse_result(id, raw):
+    """The parsed value of a Result given its id and value_ref, e.g. from values_list()"""
+    return results.parse(id, raw)
@@ -1,7 +1,12 @@
 from django.utils import simplejson as json
 from crowdforge.models import *
-from crowdforge.utils import create_hit
+from crowdforge.utils import create_hit, create_hits
+from crowdforge import codec, metrics, stats
+from crowdforge.blobstore import unpack
+from crowdforge.ratings import RatingMatrix, summarize
 from django.db.models import Q
+from itertools import groupby
+import logging
 
 class Flow():
     
@@ -15,28 +20,41 @@ class Flow():
     def end(self):
         self.problem.is_active = False
         self.problem.save()
+        stats.refresh_active_hits(self.problem)
+        metrics.event('problem_finished', problem=self.problem.pk)
         
     # utility methods
     def create_hit(self, hit_type, params={}):
-        print 'create hit', hit_type, 'params', params
-        create_hit(self.problem, hit_type, params)
+        metrics.event('create_hit', problem=self.problem.pk, stage=hit_type.pk, params=json.dumps(params))
+        return create_hit(self.problem, hit_type, params)
+        
+    def create_hits(self, hit_type, params_list):
+        metrics.event('create_hits', problem=self.problem.pk, stage=hit_type.pk, count=len(params_list))
+        return create_hits(self.problem, hit_type, params_list)
+        
+    def get_rating_matrix(self, stage):
+        """All votes of a voting stage of this problem, see crowdforge.ratings"""
+        return RatingMatrix.from_results(Result.objects.filter(hit__problem=self.problem, hit__hit_type=stage))
         
     def set_stage(self, stage):
         self.problem.stage = stage
         self.problem.save()
+        stats.refresh_active_hits(self.problem)
+        metrics.event('stage_started', problem=self.problem.pk, stage=stage.pk)
     
     # callbacks
     def on_hit_complete(self, hit):
-        print "hit complete", hit
+        metrics.event('hit_complete', problem=self.problem.pk, hit=hit.pk, hit_id=hit.hit_id)
 
     def on_hit_expired(self, hit):
-        print "hit expired", hit
+        metrics.event('hit_expired', problem=self.problem.pk, hit=hit.pk, hit_id=hit.hit_id)
 
     def on_results_retrieved(self, results):
-        print "results retrieved", results
+        metrics.event('results_retrieved', problem=self.problem.pk, count=len(results), 
+            results=','.join([str(r.pk) for r in results]))
     
     def on_stage_completed(self, stage):
-        pass
+        metrics.event('stage_completed', problem=self.problem.pk, stage=stage.pk)
 
         
 flows = {}
@@ -59,25 +77,19 @@ class SimpleFlow(Flow):
         self.create_hit(self.problem.partition)
 
     def on_stage_completed(self, stage):
-        print "completed stage, ", stage
+        Flow.on_stage_completed(self, stage)
         if stage == self.problem.partition:
             # get the partition
             partition = self.get_first_partition()
             # if the partition finished, make map HITs
-            for part in partition:
-                self.create_hit(self.problem.mapper, params={'topic': part})
+            self.create_hits(self.problem.mapper, [{'topic': part} for part in partition])
             # and we're in the map stage
             self.set_stage(self.problem.mapper)
 
         elif stage == self.problem.mapper:
-            # if the map finished, get all map hits
-            map_hits = Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper)
-            for hit in map_hits:
-                # for each map HIT, get all results for it
-                params = {'list': self.get_map_results(hit)}
-                params.update(json.loads(hit.params))
-                # creates HITs for the reduction based on those results
-                self.create_hit(self.problem.reducer, params)
+            # if the map finished, create a reduce HIT for each map HIT 
+            # based on its results
+            self.create_hits(self.problem.reducer, self.get_reduce_params())
 
             # and we're in the reduce stage
             self.set_stage(self.problem.reducer)
@@ -95,28 +107,55 @@ class SimpleFlow(Flow):
         
     def get_partition(self, result):
         partition = []
-        outline = sorted(json.loads(result.value).items())
+        outline = sorted(result.data.items())
         return [item[1] for item in outline if item[1]]
         
     def get_map_results(self, hit):
         # gets the payload for the reduce HIT.
         # we want it in an HTML list. <li>
-        # reduce template: 
-        list_html = ''
-        results = hit.result_set.all()
-        for result in results:
-            value = json.loads(result.value)
-            list_html += '<li>%s</li>' % value['fact']
-
-        return list_html
+        return self.render_map_results(hit.result_set.order_by('id').values_list('id', 'value_ref'))
+        
+    def render_map_results(self, rows):
+        # renders a map HIT's results, given as (id, value_ref) rows, as <li>s
+        return ''.join(['<li>%s</li>' % codec.parse_result(id, value)['fact'] for id, value in rows])
+        
+    def get_reduce_params(self):
+        # gets the params of the reduce HITs, one for each map HIT
+        return [params for hit_id, params in self.get_reduce_params_by_hit()]
+        
+    def get_reduce_params_by_hit(self, map_hit_ids=None):
+        # gets (map HIT id, reduce params) for each map HIT, or only these 
+        # ones, from their map results in one query, grouped by HIT
+        results = Result.objects.filter(hit__problem=self.problem, hit__hit_type=self.problem.mapper)
+        map_hits = Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper)
+        if map_hit_ids is not None:
+            results = results.filter(hit__in=map_hit_ids)
+            map_hits = map_hits.filter(pk__in=map_hit_ids)
+        results = results.order_by('hit', 'id').values_list('hit', 'id', 'value_ref').iterator()
+        lists = {}
+        for hit_id, rows in groupby(results, lambda row: row[0]):
+            lists[hit_id] = self.render_map_results([(id, value) for hit, id, value in rows])
+        
+        reduce_params = []
+        for hit_id, hit_params in map_hits.order_by('id').values_list('id', 'params_ref'):
+            params = {'list': lists.get(hit_id, '')}
+            params.update(codec.loads(unpack(hit_params)))
+            reduce_params.append((hit_id, params))
+        return reduce_params
         
 register('SimpleFlow', SimpleFlow)
 
 
 class VerificationFlow(SimpleFlow):
     
+    def on_results_retrieved(self, results):
+        SimpleFlow.on_results_retrieved(self, results)
+        # keep the running tally of the partition ratings up to date
+        votes = [r for r in results if r.hit.hit_type_id == self.problem.partition_verify_id]
+        stats.record_votes(self.problem, self.problem.partition_verify, votes)
+    
     def on_stage_completed(self, stage):
-        print "completed stage, ", stage
+        Flow.on_stage_completed(self, stage)
         if stage == self.problem.partition:
             # get the (only) partition HIT
             partition_results = Result.objects.filter(hit__problem=self.problem, 
@@ -133,20 +172,14 @@ class VerificationFlow(SimpleFlow):
             # verification HITs.
             partition = self.get_top_rated_partition()
             # make map HITs
-            for part in partition:
-                self.create_hit(self.problem.mapper, params={'topic': part})
+            self.create_hits(self.problem.mapper, [{'topic': part} for part in partition])
             # and we're in the map stage
             self.set_stage(self.problem.mapper)
             
         elif stage == self.problem.mapper:
-            # if the map finished, get all map hits
-            map_hits = Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper)
-            for hit in map_hits:
-                # for each map HIT, get all results for it
-                params = {'list': self.get_map_results(hit)}
-                params.update(json.loads(hit.params))
-                # creates HITs for the reduction based on those results
-                self.create_hit(self.problem.reducer, params)
+            # if the map finished, create a reduce HIT for each map HIT 
+            # based on its results
+            self.create_hits(self.problem.reducer, self.get_reduce_params())
 
             # and we're in the reduce stage
             self.set_stage(self.problem.reducer)
@@ -171,37 +204,81 @@ class VerificationFlow(SimpleFlow):
         return template % {'partition': partition_list, 'result_id': result.id}
             
     def get_top_rated_partition(self):
-        # assume there's just one partition HIT
-        partition_hit = Hit.objects.get(problem=self.problem, hit_type=self.problem.partition_verify)
-        results = partition_hit.result_set.all()
-        # compute ratings for each of the partition results
-        # dictionary of partition_id: [average_rating, number_of_ratings]
-        ratings = {}
+        # recount the ratings rather than trusting the running tally, which
+        # misses the votes of a poller that died between storing the vote
+        # results and tallying them; this only runs once per problem
+        stats.rebuild_tallies(self.problem, self.problem.partition_verify)
+        top = stats.get_top_rated(self.problem, self.problem.partition_verify)
+        if top is None:
+            # nobody rated the partitions (e.g. the verification HIT expired
+            # empty), so go on with the first one like SimpleFlow does
+            metrics.event('no_votes', logging.WARNING, problem=self.problem.pk)
+            return self.get_first_partition()
+        return self.get_partition(top.partition)
+        
+register('VerificationFlow', VerificationFlow)
+
+class Pipelined:
+    """
+    Runs the map and reduce stages of a flow without a barrier between them:
+    each map HIT's reduce HIT is made as soon as the map HIT is done (or has
+    expired) instead of once all map HITs are. The problem stays in the map
+    stage until the last map HIT is done and then waits for the remaining 
+    reduce HITs as usual.
+    
+    Mix in before the flow and set barrier_flow to it, see PipelinedFlow.
+    """
+    barrier_flow = None
+    
+    def on_hit_complete(self, hit):
+        self.barrier_flow.on_hit_complete(self, hit)
+        self.reduce_map_hit(hit)
         
-        # get all verification results
-        for result in results:
-            # get all ratings for each turker that verified
-            user_ratings = json.loads(result.value)
-            for partition_id in user_ratings:
-                rating = user_ratings[partition_id]
-                if not ratings.has_key(partition_id):
-                    # if this partition hasn't been rated yet, add it
-                    ratings[partition_id] = [rating, 1]
-                else:
-                    # otherwise, recompute the new average
-                    current_rating, number_of_ratings = ratings[partition_id]
-                    ratings[partition_id] = [(current_rating + rating)/(number_of_ratings + 1), 
-                                             number_of_ratings + 1]
+    def on_hit_expired(self, hit):
+        self.barrier_flow.on_hit_expired(self, hit)
+        self.reduce_map_hit(hit)
         
-        # get the highest rated partition_id
-        rating_items = ratings.items()
-        rating_items.sort(lambda a, b: cmp(b[1][0], a[1][0]))
-        top_partition_id = rating_items[0][0]
+    def on_stage_completed(self, stage):
+        if stage != self.problem.mapper:
+            return self.barrier_flow.on_stage_completed(self, stage)
+        Flow.on_stage_completed(self, stage)
+        # the reduce HITs exist already, except for map HITs whose callback
+        # never ran, e.g. because the poller crashed right before it
+        unreduced = Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper, is_reduced=False)
+        self.create_reduce_hits(list(unreduced.order_by('id').values_list('id', flat=True)))
+        self.set_stage(self.problem.reducer)
         
-        # return the partition object
-        return self.get_partition(Result.objects.get(pk=top_partition_id))
+    def reduce_map_hit(self, hit):
+        # only once the map HIT is retired; invalid HITs count as expired
+        # on every poll but stay active
+        if hit.hit_type_id != self.problem.mapper_id or hit.is_active:
+            return
+        # imported here since notifications imports the flows
+        from crowdforge import notifications
+        notifications.run_committed(self.problem, lambda: self.create_reduce_hits([hit.pk]))
+            
+    def create_reduce_hits(self, map_hit_ids):
+        # marks each map HIT reduced with a conditional UPDATE in the same
+        # transaction that makes its reduce HIT, so it only gets one even
+        # when its callback and the stage transition run at once
+        claimed = [pk for pk in map_hit_ids if Hit.objects.filter(pk=pk, is_reduced=False).update(is_reduced=True)]
+        if not claimed:
+            return []
+        params_list = []
+        for map_hit_id, params in self.get_reduce_params_by_hit(claimed):
+            params['map_hit'] = map_hit_id
+            params_list.append(params)
+        return self.create_hits(self.problem.reducer, params_list)
         
-register('VerificationFlow', VerificationFlow)
+class PipelinedFlow(Pipelined, SimpleFlow):
+    barrier_flow = SimpleFlow
+    
+register('PipelinedFlow', PipelinedFlow)
+
+class PipelinedVerificationFlow(Pipelined, VerificationFlow):
+    barrier_flow = VerificationFlow
+    
+register('PipelinedVerificationFlow', PipelinedVerificationFlow)
 
 class PartitionSelectionExperimentFlow(SimpleFlow):
     # goes partition -> reduce -> map (actually a vote)
@@ -221,16 +298,14 @@ class PartitionSelectionExperimentFlow(SimpleFlow):
         self.set_stage(self.problem.partition)
         self.create_hit(self.problem.partition)
         
-    def on_hit_complete(self, hit):
-        print "hit complete", hit
-
-    def on_hit_expired(self, hit):
-        print "hit expired", hit
-
     def on_results_retrieved(self, results):
-        print "results retrieved", results
-    
+        SimpleFlow.on_results_retrieved(self, results)
+        # the map stage is a vote on the partitions; keep a running tally
+        votes = [r for r in results if r.hit.hit_type_id == self.problem.mapper_id]
+        stats.record_votes(self.problem, self.problem.mapper, votes)
+        
     def on_stage_completed(self, stage):
+        Flow.on_stage_completed(self, stage)
         if stage == self.problem.partition:
             # get all partitions that were submitted
             partition_results = Result.objects.filter(hit__problem=self.problem, 
@@ -261,33 +336,21 @@ class PartitionSelectionExperimentFlow(SimpleFlow):
             self.end()
             
     def get_ratings(self):
-        # returns all harvested partitions and their ratings: 
-        # [{'partition': ['foo', 'bar', 'baz'], 'rating': 3.4, 'respondents': 5}, ...]
-        vote_results = Result.objects.filter(hit__hit_type=self.problem.mapper)
-        all_ratings = {}
-        # go through all vote results
-        for results in vote_results:
-            ratings = json.loads(results.value)
-            # each result contains ratings for multiple partitions
-            for partition_id in ratings:
-                new_rating = int(ratings[partition_id])
-                # if the partition already has a rating
-                if all_ratings.has_key(partition_id):
-                    curr = all_ratings[partition_id]
-                    respondents = curr['respondents']
-                    current_rating = curr['rating']
-                    curr['respondents'] += 1
-                    curr['rating'] = float(new_rating + respondents*current_rating)/(respondents + 1)
-                else:
-                    partition = Result.objects.get(pk=partition_id)
-                    all_ratings[partition_id] = {
-                        'partition': self.get_partition(partition),
-                        'respondents': 1,
-                        'rating': new_rating,
-                        'origin': partition.hit.hit_type == self.problem.partition and 'original' or 'reduced',
-                    }
-                
-        return all_ratings.values()
+        # returns all harvested partitions and their ratings, best rated first, 
+        # with the 95% confidence interval of the rating: 
+        # [{'partition': ['foo', 'bar', 'baz'], 'rating': 3.4, 'respondents': 5, 
+        #   'low': 2.9, 'high': 3.9}, ...]
+        tallies = stats.get_tallies(self.problem, self.problem.mapper)
+        summary = summarize([t.total for t in tallies], [t.total_squares for t in tallies], 
+            [t.count for t in tallies])
+        return [{
+            'partition': self.get_partition(tally.partition),
+            'respondents': tally.count,
+            'rating': tally.rating,
+            'low': float(low),
+            'high': float(high),
+            'origin': tally.partition.hit.hit_type_id == self.problem.partition_id and 'original' or 'reduced',
+        } for tally, low, high in zip(tallies, summary['low'], summary['high'])]
     
     def get_formatted_partition(self, result, template):
         partition = self.get_partition(result)
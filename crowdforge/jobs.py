@@ -0,0 +1,132 @@
+"""
+Durable queue of work for the `work` command, kept in the Job table.
+
+With FLOW_JOBS on, pollers don't run stage transitions themselves: they
+queue an 'advance' job for each problem whose stage is done and go on
+polling. A transition queues its HITs in 'post_hits' jobs of up to
+JOB_POST_BATCH HITs, in the same transaction that creates them, so any
+number of worker processes can post them side by side.
+
+Every job has a unique key, e.g. 'advance:12:3' for stage 3 of problem 12,
+so queueing the same work twice does nothing. A worker claims a job with a
+conditional UPDATE and holds it for JOB_LEASE_SECONDS; the jobs of a worker
+that died are claimed again once that runs out. Failed jobs are retried
+with exponential backoff up to JOB_MAX_ATTEMPTS times and then left in the
+'failed' state. Handlers must be safe to run again, since a worker can die
+after doing the work but before marking the job done.
+
+Handlers are registered with register(kind, function); the function is
+called with the job's arguments as keyword arguments. A handler that
+commits should call still_held() right before, so that the work of a job
+that another worker took over (because it ran past JOB_LEASE_SECONDS) is
+rolled back instead of done twice.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import simplejson as json
+import datetime
+import logging
+import threading
+import traceback
+
+import settings
+from crowdforge.models import Job
+from crowdforge import metrics
+
+# kind: function
+handlers = {}
+
+# the job being run in the current thread
+_running = threading.local()
+
+def register(kind, function):
+    handlers[kind] = function
+
+def enabled():
+    return getattr(settings, 'FLOW_JOBS', False)
+
+def now():
+    return datetime.datetime.now()
+
+def enqueue(kind, key, **args):
+    """Queue a job unless one with the same key exists. Returns whether it was queued."""
+    if Job.objects.filter(key=key).exists():
+        return False
+    try:
+        Job.objects.create(kind=kind, key=key, args=json.dumps(args), run_after=now())
+    except IntegrityError:
+        # queued by someone else in the meantime
+        transaction.rollback_unless_managed()
+        return False
+    metrics.event('job_queued', key=key)
+    return True
+
+def runnable(start):
+    """Jobs that are due, or whose worker's hold on them ran out"""
+    return Q(state=Job.QUEUED, run_after__lte=start) | Q(state=Job.RUNNING, locked_until__lte=start)
+
+def claim(owner, seconds=None):
+    """Take the next runnable job for this worker, or None"""
+    seconds = seconds or getattr(settings, 'JOB_LEASE_SECONDS', 10*60)
+    start = now()
+    for job in Job.objects.filter(runnable(start)).order_by('run_after', 'id')[:10]:
+        claimed = Job.objects.filter(runnable(start), pk=job.pk).update(state=Job.RUNNING, owner=owner,
+            locked_until=start + datetime.timedelta(seconds=seconds))
+        if claimed:
+            return Job.objects.get(pk=job.pk)
+    return None
+
+def still_held(seconds=None):
+    """
+    Whether this thread's worker still holds the job it's running, extending
+    its hold for another `seconds`. Always True outside of jobs.
+    """
+    job = getattr(_running, 'job', None)
+    if job is None:
+        return True
+    seconds = seconds or getattr(settings, 'JOB_LEASE_SECONDS', 10*60)
+    start = now()
+    return bool(Job.objects.filter(pk=job.pk, owner=job.owner, state=Job.RUNNING, locked_until__gt=start)
+        .update(locked_until=start + datetime.timedelta(seconds=seconds)))
+
+def run(job):
+    """Run a claimed job and record how it went. Returns whether it succeeded."""
+    mine = Job.objects.filter(pk=job.pk, owner=job.owner, state=Job.RUNNING)
+    _running.job = job
+    try:
+        with metrics.timer('crowdforge_job_seconds', kind=job.kind):
+            handlers[job.kind](**dict([(str(k), v) for k, v in json.loads(job.args).items()]))
+    except Exception, e:
+        transaction.rollback_unless_managed()
+        attempts = job.attempts + 1
+        metrics.registry.inc('crowdforge_job_errors_total', metrics.labels(kind=job.kind))
+        metrics.event('job_failed', logging.WARNING, key=job.key, attempt=attempts, error=e)
+        if attempts < getattr(settings, 'JOB_MAX_ATTEMPTS', 5):
+            delay = getattr(settings, 'JOB_RETRY_SECONDS', 60) * 2 ** (attempts - 1)
+            updated = mine.update(state=Job.QUEUED, attempts=attempts, error=traceback.format_exc(),
+                run_after=now() + datetime.timedelta(seconds=delay))
+        else:
+            updated = mine.update(state=Job.FAILED, attempts=attempts, error=traceback.format_exc())
+        if not updated:
+            metrics.event('job_lost', logging.WARNING, key=job.key, owner=job.owner)
+        return False
+    finally:
+        _running.job = None
+    if not mine.update(state=Job.DONE, attempts=job.attempts + 1, error=''):
+        # another worker took it over; it's up to that one now
+        metrics.event('job_lost', logging.WARNING, key=job.key, owner=job.owner)
+    return True
+
+def work(owner, limit=None):
+    """Run runnable jobs until there are none left (or `limit` ran). Returns how many ran."""
+    count = 0
+    while limit is None or count < limit:
+        job = claim(owner)
+        if job is None:
+            break
+        run(job)
+        count += 1
+    return count
+
+metrics.registry.describe('crowdforge_job_seconds', 'histogram', 'Time spent running jobs')
+metrics.registry.describe('crowdforge_job_errors_total', 'counter', 'Jobs that raised an error')
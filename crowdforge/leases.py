@@ -0,0 +1,133 @@
+"""
+Leases that split the active problems between several pollers.
+
+Every active problem has a Lease row saying which poller handles it and
+until when. A poller claims the problems it handles at the start of each
+cycle and only checks their HITs and stage transitions, so several poll (or
+polld) processes, on one machine or many, can run side by side. Claiming and
+renewing are single conditional UPDATEs, so two pollers can never both hold
+a problem.
+
+A poller takes its fair share of the problems: the active problems divided
+by the number of live pollers, which keep a heartbeat in the Poller table.
+It gives problems back when more pollers show up and takes over the problems
+of a poller that stopped once their leases run out.
+
+A stage transition only commits if the poller still holds the lease at the
+end of it, see notifications.advance(). Transitions run outside of sharded
+polling (plain poll, the notify view) take the problem's lease just for the
+transition, so they never run alongside a sharded poller's.
+"""
+from django.db import IntegrityError, transaction
+import datetime
+import math
+import os
+import socket
+import uuid
+
+from crowdforge.models import Lease, Poller, Problem
+from crowdforge.utils import chunks
+
+def get_owner():
+    """A name for this poller process"""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def get_transient_owner():
+    """A name for one unsharded transition, unique even between threads"""
+    return '%s:%s' % (get_owner(), uuid.uuid4().hex[:8])
+
+def now():
+    return datetime.datetime.now()
+
+def create_missing():
+    """Make a lease row, held by nobody, for every active problem that has none"""
+    missing = Problem.objects.filter(is_active=True, lease__isnull=True).values_list('id', flat=True)
+    for problem_id in missing:
+        try:
+            Lease.objects.create(problem_id=problem_id, owner='', expires=now())
+        except IntegrityError:
+            # another poller made it first
+            transaction.rollback_unless_managed()
+
+def heartbeat(owner, expires):
+    """Let the other pollers know this one is around until `expires`"""
+    if not Poller.objects.filter(name=owner).update(expires=expires):
+        try:
+            Poller.objects.create(name=owner, expires=expires)
+        except IntegrityError:
+            transaction.rollback_unless_managed()
+            Poller.objects.filter(name=owner).update(expires=expires)
+
+def claim(owner, seconds):
+    """
+    Renew this poller's leases and claim or give back problems to hold its
+    fair share, for the next `seconds`. Returns the ids of the problems held.
+    """
+    # finished problems don't need leases any more
+    Lease.objects.filter(problem__is_active=False).delete()
+    create_missing()
+
+    start = now()
+    expires = start + datetime.timedelta(seconds=seconds)
+    heartbeat(owner, expires)
+    Poller.objects.filter(expires__lte=start).delete()
+    Lease.objects.filter(owner=owner, expires__gt=start).update(expires=expires)
+
+    pollers = max(1, Poller.objects.filter(expires__gt=start).count())
+    share = int(math.ceil(Lease.objects.count() / float(pollers)))
+
+    held = list(Lease.objects.filter(owner=owner, expires__gt=start).order_by('problem').values_list('problem', flat=True))
+    if len(held) > share:
+        # let the newcomers have the rest
+        for problem_ids in chunks(held[share:]):
+            Lease.objects.filter(owner=owner, problem__in=problem_ids).update(owner='', expires=start)
+        return held[:share]
+
+    free = Lease.objects.filter(expires__lte=start).order_by('expires', 'problem').values_list('problem', flat=True)
+    for problem_id in free[:share - len(held)]:
+        if Lease.objects.filter(problem=problem_id, expires__lte=start).update(owner=owner, expires=expires):
+            held.append(problem_id)
+    return held
+
+def take(problem_id, owner, seconds):
+    """
+    Take the problem's lease for the next `seconds` unless some poller holds
+    it, e.g. for one transition outside of sharded polling. Returns whether
+    it was taken.
+    """
+    start = now()
+    expires = start + datetime.timedelta(seconds=seconds)
+    if Lease.objects.filter(problem=problem_id, expires__lte=start).update(owner=owner, expires=expires):
+        return True
+    if Lease.objects.filter(problem=problem_id).exists():
+        return False
+    try:
+        Lease.objects.create(problem_id=problem_id, owner=owner, expires=expires)
+    except IntegrityError:
+        # another poller made it first
+        transaction.rollback_unless_managed()
+        return False
+    return True
+
+def give_back(problem_id, owner):
+    """Let go of the problem's lease if this owner still holds it"""
+    Lease.objects.filter(problem=problem_id, owner=owner).update(owner='', expires=now())
+
+def renew(problem_id, owner, seconds):
+    """Extend this poller's lease on the problem; False if it doesn't hold it any more"""
+    start = now()
+    return bool(Lease.objects.filter(problem=problem_id, owner=owner, expires__gt=start)
+        .update(expires=start + datetime.timedelta(seconds=seconds)))
+
+def held_problems():
+    """The ids of the problems some poller holds the lease on, as a subquery"""
+    return Lease.objects.filter(expires__gt=now()).exclude(owner='').values('problem')
+
+def is_held(problem_id):
+    """Whether some poller holds the problem's lease"""
+    return held_problems().filter(problem=problem_id).exists()
+
+def release(owner):
+    """Give back all of this poller's leases, e.g. when it shuts down"""
+    Lease.objects.filter(owner=owner).update(owner='', expires=now())
+    Poller.objects.filter(name=owner).delete()
@@ -0,0 +1,179 @@
+from django.conf import settings as django_settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.utils import simplejson as json
+from optparse import make_option
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from crowdforge.models import *
+from crowdforge import metrics, simulator, utils
+
+class Command(BaseCommand):
+    help = 'run synthetic problems through poll cycles against the MTurk simulator and report JSON'
+    option_list = BaseCommand.option_list + (
+        make_option('--problems', dest='problems', type='int', default=5,
+            help='Number of synthetic problems'),
+        make_option('--flow', dest='flow', default='SimpleFlow',
+            help='Flow of the problems: SimpleFlow or PipelinedFlow'),
+        make_option('--partition-size', dest='partition_size', type='int', default=5,
+            help='Number of items in each partition, i.e. map HITs per problem'),
+        make_option('--assignments', dest='assignments', type='int', default=3,
+            help='Assignments for each map and reduce HIT'),
+        make_option('--workers', dest='workers', type='int', default=1,
+            help='Number of threads checking HITs on AMT concurrently'),
+        make_option('--step', dest='step', type='int', default=600,
+            help='Simulated seconds between poll cycles'),
+        make_option('--max-cycles', dest='max_cycles', type='int', default=200,
+            help='Give up after this many poll cycles'),
+        make_option('--arrival-rate', dest='arrival_rate', type='float', default=1/60.0,
+            help='Simulated workers per second picking up an assignment of a HIT'),
+        make_option('--error-rate', dest='error_rate', type='float', default=0.0,
+            help='Fraction of simulated MTurk calls that fail'),
+        make_option('--seed', dest='seed', type='int', default=1,
+            help='Random seed of the simulator'),
+        make_option('--output', dest='output',
+            help='Write the JSON report to this file instead of stdout'),
+    )
+
+    def handle(self, **options):
+        metrics.configure_logging()
+        # the synthetic problems go into a scratch copy of the schema, like
+        # the queryplan command, and all MTurk calls go to the simulator
+        old_name = connection.settings_dict['NAME']
+        old_debug = django_settings.DEBUG
+        old_backend = utils.settings.MTURK_BACKEND
+        old_pool = utils.connection_pool
+        old_blob_root = getattr(utils.settings, 'BLOB_ROOT', None)
+        old_stdout = sys.stdout
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # queries are only logged with DEBUG on
+            django_settings.DEBUG = True
+            utils.settings.MTURK_BACKEND = 'crowdforge.simulator.SimulatedConnection'
+            utils.connection_pool = utils.ConnectionPool(options['workers'])
+            utils.settings.BLOB_ROOT = tempfile.mkdtemp()
+            # keep the flows' and poll's chatter out of the report
+            if int(options.get('verbosity', 1)) < 2:
+                sys.stdout = open(os.devnull, 'w')
+                logging.getLogger('crowdforge').setLevel(logging.WARNING)
+            report = self.run(options)
+        finally:
+            sys.stdout = old_stdout
+            simulator.install(None)
+            utils.connection_pool = old_pool
+            if utils.settings.BLOB_ROOT != old_blob_root:
+                shutil.rmtree(utils.settings.BLOB_ROOT)
+                utils.settings.BLOB_ROOT = old_blob_root
+            utils.settings.MTURK_BACKEND = old_backend
+            django_settings.DEBUG = old_debug
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options.get('output'):
+            f = open(options['output'], 'w')
+            f.write(output + '\n')
+            f.close()
+        else:
+            print output
+
+    def run(self, options):
+        # flows registers its flow types in the database on import, so it
+        # has to be imported once the scratch database exists
+        from crowdforge import flows
+        from crowdforge.management.commands.poll import Command as PollCommand
+
+        if options['flow'] not in ('SimpleFlow', 'PipelinedFlow'):
+            raise CommandError('The benchmark only runs SimpleFlow and PipelinedFlow problems')
+        problems = self.create_problems(options['problems'], options['partition_size'], options['assignments'],
+            options['flow'])
+        roles = self.roles
+        sim = simulator.install(simulator.SimulatedMTurk(arrival_rate=options['arrival_rate'],
+            error_rate=options['error_rate'], answer=self.answer, seed=options['seed']))
+
+        # time each stage transition by wrapping the flow's callback
+        transitions = {}
+        base = flows.flows[options['flow']]
+        class TimedFlow(base):
+            def on_stage_completed(self, stage):
+                start = time.time()
+                base.on_stage_completed(self, stage)
+                to = self.problem.is_active and roles.get(self.problem.stage_id) or 'end'
+                name = '%s -> %s' % (roles.get(stage.pk), to)
+                transitions.setdefault(name, []).append(time.time() - start)
+        flows.flows[options['flow']] = TimedFlow
+
+        cycles = []
+        start = time.time()
+        try:
+            for n in range(options['max_cycles']):
+                reset_queries()
+                calls = sim.total_calls()
+                cycle_start = time.time()
+                PollCommand().post_notifications(workers=options['workers'])
+                cycles.append({
+                    'queries': len(connection.queries),
+                    'mturk_calls': sim.total_calls() - calls,
+                    'seconds': round(time.time() - cycle_start, 4),
+                })
+                if not Problem.objects.filter(pk__in=problems, is_active=True).exists():
+                    break
+                sim.advance(options['step'])
+        finally:
+            flows.flows[options['flow']] = base
+        elapsed = time.time() - start
+
+        return {
+            'options': dict([(k, options[k]) for k in ('problems', 'flow', 'partition_size', 'assignments',
+                'workers', 'step', 'arrival_rate', 'error_rate', 'seed')]),
+            'finished': Problem.objects.filter(pk__in=problems, is_active=False).count(),
+            'hits': Hit.objects.filter(problem__in=problems).count(),
+            'results': Result.objects.filter(hit__problem__in=problems).count(),
+            'cycles': len(cycles),
+            'wall_seconds': round(elapsed, 4),
+            'queries_per_cycle': summarize([c['queries'] for c in cycles]),
+            'mturk_calls_per_cycle': summarize([c['mturk_calls'] for c in cycles]),
+            'mturk_calls': sim.calls,
+            'stage_transitions': dict([(name, summarize(times, 4)) for name, times in transitions.items()]),
+            # kilobytes on Linux, bytes on Mac OS X
+            'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'per_cycle': cycles,
+        }
+
+    def create_problems(self, count, partition_size, assignments, flow='SimpleFlow'):
+        """Synthetic problems whose partition HIT asks for `partition_size` items"""
+        items = ''.join(['<input type="text" name="item%d" />' % (i + 1) for i in range(partition_size)])
+        partition = HitType.objects.create(title='benchmark partition', description='partition',
+            body=items, keywords='benchmark', max_assignments=1)
+        mapper = HitType.objects.create(title='benchmark map', description='map %(topic)s',
+            body='%(topic)s <input type="text" name="fact" />', keywords='benchmark',
+            max_assignments=assignments)
+        reducer = HitType.objects.create(title='benchmark reduce', description='reduce %(topic)s',
+            body='<ul>%(list)s</ul><textarea name="paragraph"></textarea>', keywords='benchmark',
+            max_assignments=assignments)
+        self.roles = {partition.pk: 'partition', mapper.pk: 'map', reducer.pk: 'reduce'}
+        self.partition_size = partition_size
+
+        flow, created = FlowType.objects.get_or_create(name=flow)
+        return [Problem.objects.create(name='benchmark %d' % i, flow=flow, partition=partition,
+            mapper=mapper, reducer=reducer).pk for i in range(count)]
+
+    def answer(self, title, external_url, worker_id):
+        """Scripted answers, so that the simulator never reads the database from a worker thread"""
+        if title == 'benchmark partition':
+            return dict([('item%d' % (i + 1), 'topic %d' % (i + 1)) for i in range(self.partition_size)])
+        return {'fact': 'fact by %s' % worker_id, 'paragraph': 'paragraph by %s' % worker_id}
+
+def summarize(values, digits=2):
+    if not values:
+        return {'count': 0, 'mean': 0, 'max': 0, 'total': 0}
+    total = sum(values)
+    if isinstance(total, float):
+        total = round(total, digits)
+    return {'count': len(values), 'mean': round(float(total) / len(values), digits),
+        'max': max(values), 'total': total}
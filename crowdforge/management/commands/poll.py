@@ -1,60 +1,111 @@
 from django.core.management.base import BaseCommand, CommandError
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
+import logging
 import os
 import sys
 
+import settings
 from crowdforge.models import *
-from crowdforge.utils import fetch_results, is_expired, is_complete
-from crowdforge import flows
+from crowdforge.utils import try_get_snapshot, connection_pool, post_pending_hits
+from crowdforge import jobs, leases, metrics, notifications
 
 class Command(BaseCommand):
     help='solve problems'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=1,
+            help='Number of threads checking HITs on AMT concurrently'),
+        make_option('--shard', dest='shard', action='store_true', default=False,
+            help='Only handle a share of the active problems, leased from the database, '
+                'so that several pollers can run at once'),
+    )
     
     def handle(self, **options):
-        # run through AMT data and post any necessary notifications
-        self.post_notifications()
+        metrics.configure_logging()
+        workers = int(options.get('workers') or 1)
+        connection_pool.ensure_size(workers)
+        owner = options.get('shard') and leases.get_owner() or None
+        try:
+            # run through AMT data and post any necessary notifications
+            self.post_notifications(workers=workers, owner=owner)
+        finally:
+            # every run is a new poller; don't leave its leases to run out
+            if owner is not None:
+                leases.release(owner)
+        metrics.event('poll', **connection_pool.stats())
+        metrics.flush()
         
-    def post_notifications(self):
+    def post_notifications(self, workers=1, owner=None):
         """
         Generates up to four notifications to be handled by the problem's Flow object
         1. result retrieved
         2. hit expired
         3. hit complete
         4. stage complete
+        
+        With an owner, only for the problems that poller holds the lease on.
         """
-        # go through active hits
-        active_hits = Hit.objects.filter(is_active=True)
+        # go through active hits, grouped by problem
+        # polling only needs the HIT's ids, not its payloads
+        active_hits = Hit.objects.filter(is_active=True).exclude(hit_id__startswith='?') \
+            .select_related('problem__flow').defer(*Hit.PAYLOADS).order_by('problem', 'id')
+        if owner is not None:
+            self.claim(owner)
+            active_hits = active_hits.filter(problem__lease__owner=owner)
+        elif not jobs.enabled():
+            self.post_pending()
         
         # go through active hits to check if there are any new results.
-        for hit in active_hits:
-            results = fetch_results(hit)
-            if results:
-                flow = flows.get(hit.problem)
-                # post notifications (results retrieved)
-                flow.on_results_retrieved(results)
-
-                if is_expired(hit):
-                    # post notifications (hit expired)
-                    flow.on_hit_expired(hit)
-                elif is_complete(hit):
-                    # post notifications (hit complete)
-                    flow.on_hit_complete(hit)
+        # one snapshot per HIT: results, expiry and completion all come from it
+        for snapshot in self.fetch_snapshots(active_hits, workers):
+            notifications.process_snapshot(snapshot)
         
-        # go through active problems 
-        active_problems = Problem.objects.filter(is_active=True)
-    
-        for problem in active_problems:
-            flow = flows.get(problem)
-            # if no stage, problem isn't being solved yet
-            if not problem.stage:
-                # start the flow
-                flow.start()
-                continue
-            
-            # fetch all currently active hits for this stage of the problem again
-            active_hits = Hit.objects.filter(problem=problem, hit_type=problem.stage, is_active=True)
-            
-            # if there are no active hits
-            if not active_hits:
-                # post notifications (stage complete)
-                flow.on_stage_completed(problem.stage)
\ No newline at end of file
+        # go through the active problems that need to start or whose stage
+        # just completed, found with one query
+        notifications.check_problems(owner=owner)
+        
+    def claim(self, owner):
+        """Claim this poller's share of the problems and post their HITs that a crashed poller left unposted"""
+        held = leases.claim(owner, getattr(settings, 'POLL_LEASE_SECONDS', 5*60))
+        metrics.event('leases', owner=owner, problems=len(held))
+        if jobs.enabled():
+            # the post_hits jobs take care of them
+            return
+        try:
+            post_pending_hits(Hit.objects.filter(problem__lease__owner=owner))
+        except Exception, e:
+            metrics.event('post_failed', logging.WARNING, owner=owner, error=e)
+                
+    def post_pending(self):
+        """
+        Post the HITs that a failed or crashed post left unposted, once they've
+        been left alone for MTURK_POST_PENDING_SECONDS. HITs of problems a
+        poller holds the lease on are left to it.
+        """
+        hits = Hit.objects.exclude(problem__in=leases.held_problems())
+        try:
+            post_pending_hits(hits, min_age=getattr(settings, 'MTURK_POST_PENDING_SECONDS', 10*60))
+        except Exception, e:
+            metrics.event('post_failed', logging.WARNING, error=e)
+                
+    def fetch_snapshots(self, hits, workers=1):
+        """
+        Yields a snapshot for each of the hits, in order. HITs that couldn't
+        be checked on AMT are skipped until the next poll.
+        
+        With more than one worker, the AMT calls are made from a thread pool
+        while the caller keeps all database writes and Flow callbacks on the
+        current thread, so a problem's flow never runs concurrently.
+        """
+        if workers <= 1:
+            snapshots = (try_get_snapshot(hit) for hit in hits)
+        else:
+            pool = ThreadPool(workers)
+            snapshots = pool.imap(try_get_snapshot, list(hits))
+        try:
+            for snapshot in snapshots:
+                if snapshot is not None:
+                    yield snapshot
+        finally:
+            if workers > 1:
+                pool.terminate()
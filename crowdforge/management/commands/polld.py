@@ -0,0 +1,124 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from optparse import make_option
+import time
+
+from crowdforge.models import *
+from crowdforge.utils import chunks, connection_pool
+from crowdforge.schedule import HitSchedule
+from crowdforge import jobs, leases, metrics, notifications
+from crowdforge.management.commands.poll import Command as PollCommand
+
+class Command(PollCommand):
+    help = 'keep polling AMT, checking each HIT only as often as it needs'
+    option_list = PollCommand.option_list + (
+        make_option('--min-interval', dest='min_interval', type='int', default=30,
+            help='Seconds between checks of a busy HIT'),
+        make_option('--max-interval', dest='max_interval', type='int', default=15*60,
+            help='Longest time in seconds an idle HIT goes unchecked'),
+        make_option('--rescan', dest='rescan', type='int', default=60,
+            help='Seconds between looking for new HITs and problems'),
+    )
+
+    def handle(self, **options):
+        metrics.configure_logging()
+        workers = int(options.get('workers') or 1)
+        connection_pool.ensure_size(workers)
+        schedule = HitSchedule(options['min_interval'], options['max_interval'])
+        owner = options.get('shard') and leases.get_owner() or None
+        try:
+            self.run(schedule, workers, options['rescan'], owner=owner)
+        finally:
+            if owner is not None:
+                leases.release(owner)
+
+    def run(self, schedule, workers=1, rescan=60, cycles=None, owner=None):
+        """
+        Check HITs as they come due on the schedule. Every `rescan` seconds,
+        unscheduled HITs are added to the schedule, HITs left unposted are
+        posted and all active problems are checked for stage transitions.
+        
+        With an owner, only the problems that poller holds the lease on are
+        handled, and the leases are renewed on every rescan.
+        """
+        next_rescan = 0
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            cycle += 1
+            now = time.time()
+            if now >= next_rescan:
+                self.rescan(schedule, owner)
+                next_rescan = now + rescan
+
+            self.check_due(schedule, workers, owner)
+            metrics.flush()
+
+            # don't keep transactions open or queries around between cycles
+            connection.close()
+            reset_queries()
+
+            if cycles is None or cycle < cycles:
+                wake = min(schedule.next_check() or next_rescan, next_rescan)
+                time.sleep(max(0, wake - time.time()))
+
+    def rescan(self, schedule, owner=None):
+        if owner is not None:
+            self.claim(owner)
+        elif not jobs.enabled():
+            self.post_pending()
+        # every active HIT that isn't scheduled yet: besides the new ones,
+        # HITs posted after a higher one (a retried post, parallel post_hits
+        # jobs) and, when sharded, the HITs of problems that changed hands
+        hits = Hit.objects.all()
+        if owner is not None:
+            hits = hits.filter(problem__lease__owner=owner)
+        self.add_hits(schedule, hits)
+        notifications.check_problems(owner=owner)
+        self.add_new_hits(schedule, owner)
+        
+    def add_new_hits(self, schedule, owner=None):
+        """Schedule HITs created since the last look, to be checked right away"""
+        hits = Hit.objects.filter(pk__gt=schedule.last_pk)
+        if owner is not None:
+            hits = hits.filter(problem__lease__owner=owner)
+        self.add_hits(schedule, hits)
+        
+    def add_hits(self, schedule, hits):
+        for pk in hits.filter(is_active=True).exclude(hit_id__startswith='?').values_list('id', flat=True):
+            schedule.add(pk)
+
+    def check_due(self, schedule, workers=1, owner=None):
+        due = schedule.due()
+        if not due:
+            return
+        # HITs that were retired elsewhere (e.g. by a notification) drop out here
+        hits = []
+        for pks in chunks(due):
+            due_hits = Hit.objects.filter(pk__in=pks, is_active=True).select_related('problem__flow') \
+                .defer(*Hit.PAYLOADS)
+            if owner is not None:
+                # and HITs of problems that went to another poller
+                due_hits = due_hits.filter(problem__lease__owner=owner)
+            hits.extend(due_hits)
+        hits.sort(key=lambda hit: (hit.problem_id, hit.id))
+        for pk in set(due) - set([hit.pk for hit in hits]):
+            schedule.remove(pk)
+
+        problem_ids = set()
+        failed = set([hit.pk for hit in hits])
+        for snapshot in self.fetch_snapshots(hits, workers):
+            failed.discard(snapshot.hit.pk)
+            results = notifications.process_snapshot(snapshot)
+            schedule.checked(snapshot, results)
+            if not snapshot.hit.is_active:
+                problem_ids.add(snapshot.hit.problem_id)
+        # try again soon for HITs that couldn't be checked on AMT
+        for pk in failed:
+            schedule.retry(pk)
+
+        # a retired HIT may have been the last one in its stage
+        if problem_ids:
+            notifications.check_problems(problem_ids, owner)
+        self.add_new_hits(schedule, owner)
+
+        metrics.event('checked', hits=len(hits), failed=len(failed), scheduled=len(schedule))
@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+import time
+
+from crowdforge.models import *
+from crowdforge.utils import bulk_insert
+
+class Command(BaseCommand):
+    help = 'show query plans and timings for the poll queries on a synthetic database'
+    option_list = BaseCommand.option_list + (
+        make_option('--results', dest='results', type='int', default=1000000,
+            help='Number of synthetic results to generate'),
+        make_option('--results-per-hit', dest='results_per_hit', type='int', default=5,
+            help='Number of results for each synthetic HIT'),
+        make_option('--hits-per-problem', dest='hits_per_problem', type='int', default=100,
+            help='Number of HITs for each synthetic problem'),
+        make_option('--repeat', dest='repeat', type='int', default=20,
+            help='Number of times each query is timed'),
+    )
+
+    BATCH_SIZE = 10000
+
+    def handle(self, **options):
+        # the synthetic rows go into a scratch copy of the schema (the same
+        # one the test runner uses), never into the real tables
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            problem, stage = self.populate(options['results'], options['results_per_hit'],
+                options['hits_per_problem'])
+            self.explain_all(problem, stage, options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def populate(self, result_count, results_per_hit, hits_per_problem):
+        """
+        Fill the tables with synthetic problems, HITs and results.
+        About 10% of the problems and 5% of the HITs are active, which is
+        roughly what a long-running installation looks like.
+        """
+        start = time.time()
+        flow_type = FlowType.objects.create(name='queryplan')
+        stage = HitType.objects.create(title='queryplan', description='', body='', keywords='')
+
+        hit_count = max(1, result_count / results_per_hit)
+        problem_count = max(1, hit_count / hits_per_problem)
+        bulk_insert(Problem, [Problem(name='queryplan %d' % i, flow=flow_type, stage=stage, is_active=(i % 10 == 0),
+            partition=stage, mapper=stage, reducer=stage) for i in range(problem_count)])
+        problem_ids = list(Problem.objects.filter(flow=flow_type).values_list('id', flat=True))
+
+        for batch in range(0, hit_count, self.BATCH_SIZE):
+            bulk_insert(Hit, [Hit(hit_id='QP%d' % i, hit_type=stage, problem_id=problem_ids[i % problem_count],
+                title='', description='', body='', is_active=(i % 20 == 0))
+                for i in range(batch, min(batch + self.BATCH_SIZE, hit_count))])
+        hit_ids = list(Hit.objects.filter(hit_type=stage).values_list('id', flat=True))
+
+        for batch in range(0, result_count, self.BATCH_SIZE):
+            bulk_insert(Result, [Result(assignment_id='QP%d' % i, hit_id=hit_ids[i % len(hit_ids)], value='{}')
+                for i in range(batch, min(batch + self.BATCH_SIZE, result_count))])
+
+        print 'generated %d problems, %d hits and %d results in %.1fs' % (
+            problem_count, hit_count, result_count, time.time() - start)
+        return Problem.objects.get(pk=problem_ids[0]), stage
+
+    def explain_all(self, problem, stage, repeat):
+        # notifications imports the flows, which register their flow types in
+        # the database on import, so it has to be imported once it exists
+        from crowdforge.notifications import get_stalled_problems
+        queries = [
+            ('active hits', Hit.objects.filter(is_active=True).defer(*Hit.PAYLOADS).order_by('problem', 'id')),
+            ('stalled problems', get_stalled_problems()),
+            ('active hits for stage', Hit.objects.filter(problem=problem, hit_type=stage, is_active=True)),
+            ('result for assignment', Result.objects.filter(assignment_id='QP%d' % (repeat * 7))),
+        ]
+        for name, queryset in queries:
+            self.explain(name, queryset, repeat)
+
+    def explain(self, name, queryset, repeat):
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        cursor = connection.cursor()
+        if connection.settings_dict['ENGINE'].endswith('sqlite3'):
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        else:
+            cursor.execute('EXPLAIN ' + sql, params)
+        plan = cursor.fetchall()
+
+        start = time.time()
+        for i in range(repeat):
+            cursor.execute(sql, params)
+            rows = len(cursor.fetchall())
+        elapsed = (time.time() - start) / repeat
+
+        print
+        print '%s: %d rows, %.2fms' % (name, rows, elapsed * 1000)
+        print sql % tuple([repr(p) for p in params])
+        for line in plan:
+            print '  ' + ' | '.join([unicode(col) for col in line])
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from optparse import make_option
+import time
+
+from crowdforge import jobs, leases, metrics
+
+class Command(BaseCommand):
+    help = 'run queued stage transitions and HIT postings (see FLOW_JOBS)'
+    option_list = BaseCommand.option_list + (
+        make_option('--once', dest='once', action='store_true', default=False,
+            help='Exit once there are no runnable jobs left'),
+        make_option('--sleep', dest='sleep', type='int', default=5,
+            help='Seconds to wait before looking for jobs again when there are none'),
+    )
+
+    def handle(self, **options):
+        metrics.configure_logging()
+        # notifications registers the job handlers; it imports the flows,
+        # which register themselves in the database on import
+        from crowdforge import notifications
+        owner = leases.get_owner()
+        while True:
+            count = jobs.work(owner)
+            if count:
+                metrics.event('worked', owner=owner, jobs=count)
+            metrics.flush()
+            # don't keep transactions open or queries around between batches
+            connection.close()
+            reset_queries()
+            if options.get('once'):
+                break
+            if not count:
+                time.sleep(options['sleep'])
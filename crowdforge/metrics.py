@@ -0,0 +1,277 @@
+"""
+Counters and latency histograms for the hot paths: MTurk calls, database
+queries and Flow callbacks, labelled by problem and stage.
+
+The labels come from the current context, set with metrics.context() around
+the work done for one HIT or problem, so a database query made inside a flow
+callback is counted against that problem and stage. Contexts are per thread.
+
+Each process keeps its own registry. poll and polld flush theirs into
+METRICS_FILE after every cycle and the metrics view serves the sum of the
+file and its own registry in the Prometheus text format.
+
+Also has event(), which writes structured log lines (event=name key=value)
+to the 'crowdforge' logger.
+"""
+from contextlib import contextmanager
+from django.db import connections
+from django.utils import simplejson as json
+import bisect
+import fcntl
+import logging
+import os
+import threading
+import time
+
+import settings
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+class Registry(object):
+    """Thread-safe set of counters and histograms"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name: (type, help)
+        self.descriptions = {}
+        # name: {labels: value}, where labels is a sorted tuple of (name, value)
+        # pairs and the value of a histogram is [bucket counts, sum, count]
+        self.samples = {}
+
+    def describe(self, name, kind, help):
+        self.descriptions[name] = (kind, help)
+        self.samples.setdefault(name, {})
+
+    def inc(self, name, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.samples.setdefault(name, {})
+            samples[key] = samples.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.samples.setdefault(name, {})
+            if key not in samples:
+                samples[key] = [[0] * len(BUCKETS), 0.0, 0]
+            sample = samples[key]
+            bucket = bisect.bisect_left(BUCKETS, value)
+            if bucket < len(BUCKETS):
+                sample[0][bucket] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def get(self, name, **labels):
+        """The value of a counter, or the count of a histogram"""
+        value = self.samples.get(name, {}).get(tuple(sorted(labels.items())), 0)
+        if isinstance(value, list):
+            return value[2]
+        return value
+
+    def dump(self, reset=False):
+        """All samples as a JSON-friendly dict, optionally starting over from zero"""
+        with self.lock:
+            data = dict([(name, [[list(key), value] for key, value in samples.items()])
+                for name, samples in self.samples.items()])
+            if reset:
+                for samples in self.samples.values():
+                    samples.clear()
+        return data
+
+    def merge(self, data):
+        """Add samples from dump() to this registry"""
+        with self.lock:
+            for name, samples in data.items():
+                mine = self.samples.setdefault(name, {})
+                for key, value in samples:
+                    key = tuple([tuple(pair) for pair in key])
+                    if isinstance(value, list):
+                        sample = mine.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+                        sample[0] = [a + b for a, b in zip(sample[0], value[0])]
+                        sample[1] += value[1]
+                        sample[2] += value[2]
+                    else:
+                        mine[key] = mine.get(key, 0) + value
+
+    def render(self):
+        """The Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name in sorted(self.samples):
+                kind, help = self.descriptions.get(name, ('untyped', ''))
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key, value in sorted(self.samples[name].items()):
+                    if isinstance(value, list):
+                        cumulative = 0
+                        for bound, count in zip(BUCKETS, value[0]):
+                            cumulative += count
+                            lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', repr(bound)),)), cumulative))
+                        lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', '+Inf'),)), value[2]))
+                        lines.append('%s_sum%s %r' % (name, format_labels(key), value[1]))
+                        lines.append('%s_count%s %d' % (name, format_labels(key), value[2]))
+                    else:
+                        lines.append('%s%s %r' % (name, format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(key):
+    if not key:
+        return ''
+    escape = lambda v: unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join(['%s="%s"' % (k, escape(v)) for k, v in key])
+
+registry = Registry()
+registry.describe('crowdforge_mturk_calls_total', 'counter', 'MTurk API calls')
+registry.describe('crowdforge_mturk_errors_total', 'counter', 'MTurk API calls that raised an error')
+registry.describe('crowdforge_mturk_call_seconds', 'histogram', 'Latency of MTurk API calls')
+registry.describe('crowdforge_db_queries_total', 'counter', 'Database queries')
+registry.describe('crowdforge_db_query_seconds', 'histogram', 'Latency of database queries')
+registry.describe('crowdforge_flow_callbacks_total', 'counter', 'Flow callbacks')
+registry.describe('crowdforge_flow_callback_seconds', 'histogram', 'Time spent in Flow callbacks')
+
+# the problem and stage that the current thread is working on
+_context = threading.local()
+
+def labels(**extra):
+    result = dict(getattr(_context, 'labels', None) or {'problem': '', 'stage': ''})
+    result.update(extra)
+    return result
+
+@contextmanager
+def context(problem=None, stage=None):
+    """Count everything inside the block against this problem (id) and stage (HitType id)"""
+    old = getattr(_context, 'labels', None)
+    _context.labels = {'problem': problem and str(problem) or '', 'stage': stage and str(stage) or ''}
+    try:
+        yield
+    finally:
+        _context.labels = old
+
+@contextmanager
+def timer(name, **extra):
+    """Observe how long the block takes in the histogram `name`"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        registry.observe(name, labels(**extra), time.time() - start)
+
+class InstrumentedConnection(object):
+    """Wraps an MTurk connection, counting and timing every API call by method name"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if name.startswith('_') or name == 'close' or not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            call_labels = labels(operation=name)
+            registry.inc('crowdforge_mturk_calls_total', call_labels)
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                registry.inc('crowdforge_mturk_errors_total', call_labels)
+                raise
+            finally:
+                registry.observe('crowdforge_mturk_call_seconds', call_labels, time.time() - start)
+        return call
+
+class TimedCursor(object):
+    """Wraps a database cursor, counting and timing every query"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self.timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(self.cursor.executemany, sql, param_list)
+
+    def timed(self, method, sql, params):
+        query_labels = labels()
+        registry.inc('crowdforge_db_queries_total', query_labels)
+        start = time.time()
+        try:
+            return method(sql, params)
+        finally:
+            registry.observe('crowdforge_db_query_seconds', query_labels, time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def instrument_database(db):
+    """
+    Make all cursors of the database connection's class count and time their
+    queries. Connections are thread-local, so patching the one object would
+    only cover the importing thread.
+    """
+    wrapper = type(db)
+    if wrapper.__dict__.get('instrumented', False):
+        return
+    cursor = wrapper.cursor
+    wrapper.cursor = lambda self: TimedCursor(cursor(self))
+    wrapper.instrumented = True
+
+if getattr(settings, 'METRICS_DATABASE', True):
+    for alias in connections:
+        instrument_database(connections[alias])
+
+def flush(path=None):
+    """Add this process's samples to the metrics file and start counting from zero"""
+    path = path or getattr(settings, 'METRICS_FILE', None)
+    if not path:
+        return
+    f = open(path, 'a+')
+    try:
+        # other pollers may be flushing at the same time
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        contents = f.read()
+        total = Registry()
+        if contents:
+            total.merge(json.loads(contents))
+        total.merge(registry.dump(reset=True))
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(total.dump()))
+        f.flush()
+    finally:
+        f.close()
+
+def export(path=None):
+    """The metrics file plus this process's samples in the Prometheus text format"""
+    path = path or getattr(settings, 'METRICS_FILE', None)
+    total = Registry()
+    total.descriptions = registry.descriptions
+    if path and os.path.exists(path):
+        f = open(path)
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            contents = f.read()
+        finally:
+            f.close()
+        if contents:
+            total.merge(json.loads(contents))
+    total.merge(registry.dump())
+    return total.render()
+
+log = logging.getLogger('crowdforge')
+
+def configure_logging(level=logging.INFO):
+    """Write the log lines to stderr; done by the management commands, not on import"""
+    logging.basicConfig(level=level, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+def event(name, level=logging.INFO, **fields):
+    """Log a structured line: event=name followed by the fields as key=value pairs"""
+    parts = ['event=%s' % name]
+    for key in sorted(fields):
+        value = unicode(fields[key])
+        if not value or ' ' in value or '"' in value or '=' in value:
+            value = json.dumps(value)
+        parts.append('%s=%s' % (key, value))
+    log.log(level, ' '.join(parts))
@@ -1,5 +1,8 @@
 from django.db import models
 
+from crowdforge.blobstore import BlobProperty
+from crowdforge import codec
+
 class FlowType(models.Model):
     """Represents a model for how to solve a problem"""
     name = models.CharField(max_length=100)
@@ -37,7 +40,7 @@ class Problem(models.Model):
     name = models.CharField(max_length=100)
     stage = models.ForeignKey(HitType, related_name='problem_stage', blank=True, null=True)
     
-    is_active = models.BooleanField(default=True)
+    is_active = models.BooleanField(default=True, db_index=True)
     
     # core parts of a problem need to exist
     flow = models.ForeignKey(FlowType)
@@ -70,13 +73,25 @@ class Hit(models.Model):
     hit_type = models.ForeignKey(HitType)
     problem = models.ForeignKey(Problem)
     # extra data to identify the HIT
-    params = models.TextField(blank=True)
+    params_ref = models.TextField(blank=True, db_column='params')
     # optional fields for overriding title and description
     title = models.TextField()
     description = models.TextField()
-    body = models.TextField()
+    body_ref = models.TextField(db_column='body')
+    # big params and bodies live in the blob store, see crowdforge.blobstore
+    params = BlobProperty('params_ref')
+    body = BlobProperty('body_ref')
+    # the columns to defer when only the HIT's state is needed
+    PAYLOADS = ('params_ref', 'body_ref')
     
-    is_active = models.BooleanField(default=True)
+    # (problem, hit_type, is_active) is also indexed, see sql/hit.sql
+    is_active = models.BooleanField(default=True, db_index=True)
+    # number of assignments (oldest first) whose results are stored, so that
+    # polling only fetches the pages after them
+    assignments_seen = models.IntegerField(default=0)
+    # for the map HITs of pipelined flows: whether their reduce HIT was made,
+    # see flows.Pipelined
+    is_reduced = models.BooleanField(default=False)
         
     @models.permalink
     def get_absolute_url(self):
@@ -91,15 +106,122 @@ class Result(models.Model):
     There can be many results for a single MTurk HIT
     """
     # the assignment ID on MTurk
-    assignment_id = models.CharField(max_length=100)
+    assignment_id = models.CharField(max_length=100, unique=True)
     hit = models.ForeignKey(Hit)
-    # JSON data for the result value
-    value = models.TextField()
+    # JSON data for the result value, in the blob store if it's big
+    value_ref = models.TextField(db_column='value')
+    value = BlobProperty('value_ref')
     created = models.DateTimeField(auto_now_add=True)
     
     def __unicode__(self):
         return 'Result for \"' + str(self.hit) + '\"'
         
+    @property
+    def data(self):
+        """The parsed value, cached (see crowdforge.codec); don't modify it"""
+        return codec.parse_result(self.pk, self.value_ref)
+        
     @models.permalink
     def get_absolute_url(self):
         return ('crowdforge.views.result', [str(self.id)])
+
+class Lease(models.Model):
+    """
+    Which poller handles a problem, and until when.
+    See crowdforge/leases.py
+    """
+    problem = models.OneToOneField(Problem, related_name='lease')
+    # the poller's name, empty if nobody holds it
+    owner = models.CharField(max_length=100, blank=True, db_index=True)
+    expires = models.DateTimeField(db_index=True)
+    
+    def __unicode__(self):
+        return 'Lease on %s by %s' % (self.problem_id, self.owner or 'nobody')
+
+class Poller(models.Model):
+    """A poller taking part in sharding, until its heartbeat expires"""
+    name = models.CharField(max_length=100, unique=True)
+    expires = models.DateTimeField(db_index=True)
+    
+    def __unicode__(self):
+        return self.name
+
+class Job(models.Model):
+    """
+    Work queued for the work command, e.g. a stage transition.
+    See crowdforge/jobs.py
+    """
+    QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+    
+    kind = models.CharField(max_length=50)
+    # queueing a job with the same key again does nothing
+    key = models.CharField(max_length=200, unique=True)
+    # JSON keyword arguments for the job's handler
+    args = models.TextField(blank=True)
+    state = models.CharField(max_length=10, default=QUEUED, db_index=True)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(db_index=True)
+    # the worker running it, and until when it holds it
+    owner = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    # traceback of the last failure
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    
+    def __unicode__(self):
+        return '%s (%s)' % (self.key, self.state)
+
+class ProblemStats(models.Model):
+    """
+    Running totals for a problem.
+    Kept up to date as results come in and stages change, so that dashboards
+    read this row instead of scanning the result table.
+    """
+    problem = models.OneToOneField(Problem, related_name='stats')
+    result_count = models.IntegerField(default=0)
+    cost = models.FloatField(default=0)
+    first_result = models.DateTimeField(blank=True, null=True)
+    last_result = models.DateTimeField(blank=True, null=True)
+    active_hits = models.IntegerField(default=0)
+    
+    def __unicode__(self):
+        return 'Stats for \"' + unicode(self.problem) + '\"'
+        
+    def get_duration(self):
+        if self.result_count >= 2:
+            return self.last_result - self.first_result
+        return None
+
+class StageStats(models.Model):
+    """
+    Running totals for the results of one stage (HIT type) of a problem.
+    """
+    problem = models.ForeignKey(Problem, related_name='stage_stats')
+    stage = models.ForeignKey(HitType)
+    result_count = models.IntegerField(default=0)
+    cost = models.FloatField(default=0)
+    
+    class Meta:
+        unique_together = (('problem', 'stage'),)
+    
+    def __unicode__(self):
+        return 'Stats for \"' + unicode(self.problem) + '\" at ' + unicode(self.stage)
+
+class RatingTally(models.Model):
+    """
+    Running sum, sum of squares and count of the ratings that voters gave
+    one partition (a Result) in a voting stage of a problem.
+    Updated as vote results come in, so reporting the ratings is one read.
+    """
+    problem = models.ForeignKey(Problem, related_name='rating_tallies')
+    stage = models.ForeignKey(HitType)
+    partition = models.ForeignKey(Result, related_name='tallies')
+    total = models.FloatField(default=0)
+    total_squares = models.FloatField(default=0)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = (('problem', 'stage', 'partition'),)
+    
+    def __unicode__(self):
+        return 'Ratings of #%s at %s' % (self.partition_id, unicode(self.stage))
@@ -0,0 +1,272 @@
+"""
+Turns what AMT tells us about HITs into notifications for the problem's Flow.
+
+Both the poll command and the AMT notification endpoint go through here, so a
+HIT is handled the same way whether it was polled or AMT told us about it.
+"""
+from boto.mturk.notification import NotificationMessage
+import base64
+import calendar
+import logging
+import hashlib
+import hmac
+import re
+import time
+
+from django.db import transaction
+from django.db.models import F
+
+import settings
+from crowdforge.models import Hit, Problem
+from crowdforge.utils import chunks, deferred_posting, get_snapshot, post_hits, post_pending_hits
+from crowdforge import flows, jobs, leases, metrics
+
+def process_snapshot(snapshot):
+    """
+    Post up to three notifications for a HIT to its problem's Flow object
+    1. result retrieved
+    2. hit expired
+    3. hit complete
+    Returns the new results.
+    
+    The flow is only looked up once there is something to tell it, so
+    checking an idle HIT costs no queries besides fetching the snapshot.
+    """
+    hit = snapshot.hit
+    flow = []
+    def notify(name, *args):
+        if not flow:
+            flow.append(flows.get(hit.problem))
+        callback(flow[0], name, *args)
+    with metrics.context(hit.problem_id, hit.hit_type_id):
+        results = snapshot.save_results()
+        if results:
+            # post notifications (results retrieved)
+            notify('on_results_retrieved', results)
+
+        if snapshot.is_expired():
+            # post notifications (hit expired)
+            notify('on_hit_expired', hit)
+        elif snapshot.is_complete():
+            # post notifications (hit complete)
+            notify('on_hit_complete', hit)
+    return results
+
+def get_stalled_problems(problem_ids=None, owner=None):
+    """
+    The active problems (optionally only these ids, or the ones this poller
+    holds the lease on) that haven't started yet or whose stage has no
+    active HITs left, found in one query along with their flow and stage.
+    """
+    busy = Hit.objects.filter(is_active=True, hit_type=F('problem__stage')).values('problem')
+    problems = Problem.objects.filter(is_active=True).exclude(pk__in=busy).select_related('flow', 'stage')
+    if problem_ids is not None:
+        problems = problems.filter(pk__in=list(problem_ids))
+    if owner is not None:
+        problems = problems.filter(lease__owner=owner)
+    return problems.order_by('id')
+
+def check_problems(problem_ids=None, owner=None):
+    """
+    Start the flow of all active problems, or these ones, or post stage
+    complete if their stage has no active HITs left, with a single query to
+    find the ones to advance. With FLOW_JOBS on, the transitions are queued
+    for the work command instead.
+    """
+    for problem in get_stalled_problems(problem_ids, owner):
+        if jobs.enabled():
+            queue_advance(problem)
+        else:
+            advance(problem, owner)
+
+def advance(problem, owner=None):
+    """
+    Start the problem's flow, or post stage complete for its current stage.
+    
+    With an owner, the transition only commits if that poller still holds
+    the problem's lease. Without one, the lease is taken just for this
+    transition, so problems leased by a poller are left to it and no two
+    transitions of a problem ever run at once.
+    """
+    if owner is not None:
+        return transition(problem, owner)
+    owner = leases.get_transient_owner()
+    if not leases.take(problem.pk, owner, getattr(settings, 'POLL_LEASE_SECONDS', 5*60)):
+        return False
+    try:
+        # the transition may have run since the problem was looked up
+        stalled = list(get_stalled_problems([problem.pk]))
+        if not stalled or stalled[0].stage_id != problem.stage_id:
+            return False
+        return transition(stalled[0], owner)
+    finally:
+        leases.give_back(problem.pk, owner)
+
+def transition(problem, owner=None):
+    """
+    Run the transition of advance() regardless of leases, see
+    run_committed().
+    """
+    flow = flows.get(problem)
+    def run():
+        # if no stage, problem isn't being solved yet
+        if not problem.stage_id:
+            # start the flow
+            callback(flow, 'start')
+        else:
+            # post notifications (stage complete)
+            callback(flow, 'on_stage_completed', problem.stage)
+    return run_committed(problem, run, owner)
+
+def run_committed(problem, function, owner=None):
+    """
+    Call function() in one transaction and only post the HITs it creates to
+    AMT once that commits, so a poller that crashes halfway leaves nothing
+    behind and the next one does the whole thing again. HITs whose posting
+    failed are logged and stay unposted until poll retries them (see
+    utils.post_pending_hits). With FLOW_JOBS on, the HITs are queued in
+    post_hits jobs as part of the transaction instead.
+    
+    With an owner, it only commits if that poller still holds the problem's
+    lease. Returns whether it committed.
+    """
+    seconds = getattr(settings, 'POLL_LEASE_SECONDS', 5*60)
+    with metrics.context(problem.pk, problem.stage_id):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            with deferred_posting() as hits:
+                function()
+            if owner is not None and not leases.renew(problem.pk, owner, seconds):
+                # another poller may have taken over and be running it too
+                transaction.rollback()
+                metrics.event('lease_lost', logging.WARNING, problem=problem.pk, owner=owner)
+                return False
+            if not jobs.still_held():
+                # the job ran too long and another worker is running it too
+                transaction.rollback()
+                metrics.event('job_lost', logging.WARNING, problem=problem.pk)
+                return False
+            if jobs.enabled():
+                queue_posting(hits)
+                hits = []
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            transaction.leave_transaction_management()
+        try:
+            post_hits(hits)
+        except Exception, e:
+            # the transaction committed, and the HITs that weren't posted keep
+            # their placeholder for poll to retry
+            metrics.event('post_failed', logging.WARNING, problem=problem.pk, error=e)
+    return True
+
+# jobs run by the work command, see crowdforge/jobs.py
+def queue_advance(problem):
+    jobs.enqueue('advance', 'advance:%d:%s' % (problem.pk, problem.stage_id or 'start'),
+        problem=problem.pk, stage=problem.stage_id)
+
+def run_advance(problem, stage):
+    """
+    Run the transition of the problem's stage, unless it already happened.
+    Only commits if the worker still holds the job, see jobs.still_held().
+    """
+    stalled = list(get_stalled_problems([problem]))
+    if stalled and stalled[0].stage_id == stage:
+        transition(stalled[0])
+
+def queue_posting(hits):
+    size = getattr(settings, 'JOB_POST_BATCH', 50)
+    for batch in chunks([hit.pk for hit in hits], size):
+        jobs.enqueue('post_hits', 'post_hits:%d' % batch[0], hits=batch)
+
+def run_posting(hits):
+    """Post the ones of these HITs that aren't posted yet"""
+    post_pending_hits(Hit.objects.filter(pk__in=hits))
+
+jobs.register('advance', run_advance)
+jobs.register('post_hits', run_posting)
+
+def callback(flow, name, *args):
+    """Call the flow's callback, counting and timing it"""
+    metrics.registry.inc('crowdforge_flow_callbacks_total', metrics.labels(callback=name))
+    with metrics.timer('crowdforge_flow_callback_seconds', callback=name):
+        getattr(flow, name)(*args)
+
+def process_hits(hits):
+    """Check the HITs on AMT right away and post all resulting notifications"""
+    problem_ids = set()
+    for hit in hits:
+        process_snapshot(get_snapshot(hit))
+        problem_ids.add(hit.problem_id)
+    if problem_ids:
+        check_problems(problem_ids)
+
+# AMT REST notifications, see the Notification API in the AMT developer guide
+EVENT_RE = re.compile(r'^Event\.(\d+)\.(\w+)$')
+
+def get_signature(timestamp, secret_key):
+    message = NotificationMessage.SERVICE_NAME + NotificationMessage.OPERATION_NAME + timestamp
+    return base64.b64encode(hmac.new(secret_key, message, hashlib.sha1).digest())
+
+def verify(params, secret_key, now=None):
+    """
+    Check that the notification params were signed with our secret key and
+    that their Timestamp is within MTURK_NOTIFICATION_MAX_AGE seconds of now,
+    so that a captured notification can't be replayed later.
+    """
+    if params.get('method') != NotificationMessage.OPERATION_NAME or 'Timestamp' not in params:
+        return False
+    if not compare_digest(str(params.get('Signature', '')), get_signature(params['Timestamp'], secret_key)):
+        return False
+    try:
+        # e.g. 2011-03-01T12:00:00Z or 2011-03-01T12:00:00.123Z
+        sent = calendar.timegm(time.strptime(params['Timestamp'][:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return False
+    if now is None:
+        now = time.time()
+    return abs(now - sent) <= getattr(settings, 'MTURK_NOTIFICATION_MAX_AGE', 15*60)
+
+def compare_digest(a, b):
+    """Compare the strings in constant time, so timing doesn't give the signature away"""
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    # Python < 2.7.7
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def parse_events(params):
+    """
+    Get the events from the notification params as a list of dicts, e.g.
+    [{'EventType': 'AssignmentSubmitted', 'HITId': '...', 'AssignmentId': '...'}]
+    """
+    events = {}
+    for key, value in params.items():
+        match = EVENT_RE.match(key)
+        if match:
+            events.setdefault(int(match.group(1)), {})[match.group(2)] = value
+    return [events[n] for n in sorted(events)]
+
+def build_notification(events, secret_key, sent=None):
+    """
+    Build the params of a signed notification like AMT would send it, at
+    time `sent` (default now). Lets tests and local setups stand in for AMT.
+    """
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(sent))
+    params = {'method': NotificationMessage.OPERATION_NAME, 'Timestamp': timestamp,
+        'Version': NotificationMessage.NOTIFICATION_VERSION,
+        'Signature': get_signature(timestamp, secret_key)}
+    for n, event in enumerate(events):
+        event = dict(event)
+        event.setdefault('EventTime', timestamp)
+        for key, value in event.items():
+            params['Event.%d.%s' % (n + 1, key)] = value
+    return params
@@ -0,0 +1,125 @@
+"""
+Rating statistics for voting stages, computed in bulk with NumPy.
+
+A vote result is a dict of item id: rating, e.g. partition Result id: 1-5.
+RatingMatrix puts the votes of a stage into a voters x items matrix, with
+NaN where a voter didn't rate an item, and computes the statistics of all
+items and the agreement of all voters at once. summarize() computes the same
+per-item statistics from running sums, which is what RatingTally keeps.
+
+Custom flows can use it directly:
+
+    matrix = RatingMatrix.from_results(Result.objects.filter(hit__hit_type=stage))
+    best = matrix.ranking()[0]
+"""
+import numpy
+
+# two-sided standard normal quantiles for the usual confidence levels
+Z = {0.8: 1.282, 0.9: 1.645, 0.95: 1.96, 0.99: 2.576}
+
+def get_votes(data):
+    """The item id: rating pairs of a parsed vote result, skipping anything that isn't a number"""
+    votes = {}
+    for item, rating in data.items():
+        try:
+            votes[int(item)] = float(rating)
+        except (TypeError, ValueError):
+            continue
+    return votes
+
+def summarize(totals, squares, counts, confidence=0.95):
+    """
+    Mean, sample standard deviation and confidence interval of each item,
+    given arrays of the sum, sum of squares and number of its ratings.
+    Returns a dict of arrays; the deviation and interval are NaN for items
+    with fewer than two ratings.
+    """
+    totals = numpy.asarray(totals, dtype=float)
+    squares = numpy.asarray(squares, dtype=float)
+    counts = numpy.asarray(counts, dtype=float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        means = totals / counts
+        variances = numpy.maximum(squares - totals * means, 0) / (counts - 1)
+        variances[counts < 2] = numpy.nan
+        stds = numpy.sqrt(variances)
+        half_widths = Z[confidence] * stds / numpy.sqrt(counts)
+    return {'mean': means, 'std': stds, 'count': counts.astype(int),
+        'low': means - half_widths, 'high': means + half_widths}
+
+class RatingMatrix(object):
+    def __init__(self, voters, items, ratings):
+        self.voters = list(voters)
+        self.items = list(items)
+        self.ratings = numpy.asarray(ratings, dtype=float).reshape((len(self.voters), len(self.items)))
+
+    @classmethod
+    def from_votes(cls, votes):
+        """Build the matrix from a list of (voter, {item: rating})"""
+        items = sorted(set([item for voter, ratings in votes for item in ratings]))
+        columns = dict([(item, i) for i, item in enumerate(items)])
+        rows, cols, values = [], [], []
+        for row, (voter, ratings) in enumerate(votes):
+            for item, rating in ratings.items():
+                rows.append(row)
+                cols.append(columns[item])
+                values.append(rating)
+        matrix = numpy.empty((len(votes), len(items)))
+        matrix.fill(numpy.nan)
+        if values:
+            matrix[rows, cols] = values
+        return cls([voter for voter, ratings in votes], items, matrix)
+
+    @classmethod
+    def from_results(cls, results):
+        """Build the matrix from vote Results; each assignment is a voter"""
+        return cls.from_votes([(result.assignment_id, get_votes(result.data)) for result in results])
+
+    def rated(self):
+        return ~numpy.isnan(self.ratings)
+
+    def counts(self):
+        """Number of ratings of each item"""
+        return self.rated().sum(axis=0)
+
+    def totals(self):
+        return numpy.where(self.rated(), self.ratings, 0).sum(axis=0)
+
+    def squares(self):
+        return numpy.where(self.rated(), self.ratings ** 2, 0).sum(axis=0)
+
+    def summary(self, confidence=0.95):
+        """Per-item statistics, see summarize()"""
+        return summarize(self.totals(), self.squares(), self.counts(), confidence)
+
+    def means(self):
+        return self.summary()['mean']
+
+    def ranking(self):
+        """The items, best rated first; ties keep the item order"""
+        means = self.means()
+        means[numpy.isnan(means)] = -numpy.inf
+        order = numpy.argsort(-means, kind='mergesort')
+        return [self.items[i] for i in order]
+
+    def agreement(self):
+        """
+        How well each voter agrees with the others: the correlation between
+        the voter's ratings and the mean rating the other voters gave the same
+        items. NaN for voters who rated fewer than two items that someone
+        else rated too, or who gave every item the same rating.
+        """
+        rated = self.rated()
+        ratings = numpy.where(rated, self.ratings, 0)
+        counts = rated.sum(axis=0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # leave-one-out mean of each item, for each voter who rated it
+            others = (ratings.sum(axis=0) - ratings) / (counts - 1)
+            mask = rated & (counts > 1)
+            n = mask.sum(axis=1).astype(float)
+            x = numpy.where(mask, ratings, 0)
+            y = numpy.where(mask, others, 0)
+            dx = numpy.where(mask, x - (x.sum(axis=1) / n)[:, numpy.newaxis], 0)
+            dy = numpy.where(mask, y - (y.sum(axis=1) / n)[:, numpy.newaxis], 0)
+            scores = (dx * dy).sum(axis=1) / numpy.sqrt((dx ** 2).sum(axis=1) * (dy ** 2).sum(axis=1))
+        scores[n < 2] = numpy.nan
+        return scores
@@ -0,0 +1,119 @@
+"""
+Cached rendering of HIT content.
+
+A HitType's title, description and body are Python format strings filled in
+with each HIT's params. They are parsed once into a HitTypeRenderer, kept
+per process and dropped when the HitType is saved or deleted (e.g. in
+admin). Renderers are also keyed by the format strings themselves, so a
+process that didn't see the edit still notices the new content.
+
+The worker-facing page of a Hit never changes once the Hit exists, except
+for the assignment ID and the form action, which come from the request. The
+page is rendered once with placeholders for those two and kept in the Django
+cache (see CACHE_BACKEND) by Hit id, along with an ETag and the time it was
+rendered for conditional requests.
+"""
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.template.loader import render_to_string
+from django.utils.hashcompat import md5_constructor
+from django.utils.html import escape
+import datetime
+import re
+
+import settings
+from crowdforge.models import Hit, HitType
+
+FIELD_RE = re.compile(r'%\((\w+)\)s|%%')
+
+def compile_format(format):
+    """
+    Parse a format string with %(name)s fields into a function of the params.
+    Format strings with any other conversions fall back to the % operator.
+    """
+    literals, keys = [], []
+    last = 0
+    for match in FIELD_RE.finditer(format):
+        literals.append(format[last:match.start()])
+        keys.append(match.group(1))
+        last = match.end()
+    tail = format[last:]
+    if '%' in tail or [literal for literal in literals if '%' in literal]:
+        return lambda params: format % params
+
+    def render(params):
+        parts = []
+        for literal, key in zip(literals, keys):
+            parts.append(literal)
+            parts.append(key is None and '%' or unicode(params[key]))
+        parts.append(tail)
+        return u''.join(parts)
+    return render
+
+class HitTypeRenderer(object):
+    def __init__(self, hit_type):
+        self.source = (hit_type.title, hit_type.description, hit_type.body)
+        self.title = compile_format(hit_type.title)
+        self.description = compile_format(hit_type.description)
+        self.body = compile_format(hit_type.body)
+
+    def render(self, params):
+        """The title, description and body of a HIT with these params"""
+        return self.title(params), self.description(params), self.body(params)
+
+# HitType id: HitTypeRenderer
+renderers = {}
+
+def get_renderer(hit_type):
+    renderer = renderers.get(hit_type.pk)
+    if renderer is None or renderer.source != (hit_type.title, hit_type.description, hit_type.body):
+        renderer = HitTypeRenderer(hit_type)
+        if hit_type.pk:
+            renderers[hit_type.pk] = renderer
+    return renderer
+
+def forget_hit_type(sender, instance, **kwargs):
+    renderers.pop(instance.pk, None)
+
+post_save.connect(forget_hit_type, sender=HitType)
+post_delete.connect(forget_hit_type, sender=HitType)
+
+# stand-ins for the parts of the page that depend on the request
+ACTION = '__crowdforge_action__'
+ASSIGNMENT_ID = '__crowdforge_assignment_id__'
+
+def page_key(hit_id):
+    return 'crowdforge.hit.%s' % hit_id
+
+def render_page(hit):
+    """The HIT's page with placeholders for the action and assignment ID"""
+    return render_to_string('hit.html', {'title': hit.title, 'body': hit.body,
+        'assignment_id': ASSIGNMENT_ID, 'action': ACTION})
+
+def get_page(hit_id):
+    """
+    The HIT's page from the cache, rendering it if needed, as a dict with the
+    page with placeholders ('page'), its 'etag' and when it was rendered
+    ('modified', UTC). Raises Hit.DoesNotExist.
+    """
+    entry = cache.get(page_key(hit_id))
+    if entry is None:
+        page = render_page(Hit.objects.get(pk=hit_id))
+        # whole seconds, since that's all Last-Modified can express
+        modified = datetime.datetime.utcnow().replace(microsecond=0)
+        entry = {'page': page, 'etag': md5_constructor(page.encode('utf-8')).hexdigest(), 'modified': modified}
+        cache.set(page_key(hit_id), entry, getattr(settings, 'HIT_PAGE_CACHE_SECONDS', 60*60*24))
+    return entry
+
+def fill_page(page, action, assignment_id):
+    return page.replace(ACTION, escape(action)).replace(ASSIGNMENT_ID, escape(assignment_id))
+
+def page_etag(entry, action, assignment_id):
+    """The ETag of the page filled in with this action and assignment ID"""
+    return md5_constructor(('%s %s %s' % (entry['etag'], action, assignment_id)).encode('utf-8')).hexdigest()
+
+def forget_hit(sender, instance, **kwargs):
+    cache.delete(page_key(instance.pk))
+
+post_save.connect(forget_hit, sender=Hit)
+post_delete.connect(forget_hit, sender=Hit)
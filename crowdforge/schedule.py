@@ -0,0 +1,104 @@
+"""
+Adaptive schedule of when to check each active HIT on AMT.
+
+Used by the polld daemon. A HIT is checked again soon when it is getting
+results, is nearly complete or is about to expire; idle HITs back off
+exponentially up to a maximum interval. The next check is never scheduled
+past a HIT's expiration, since expiry is the only change that AMT doesn't
+announce through new assignments.
+"""
+import datetime
+import heapq
+import time
+
+class HitSchedule(object):
+    def __init__(self, min_interval=30, max_interval=15*60):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # hit pk: [next check time, current interval]
+        self.hits = {}
+        # heap of (next check time, hit pk), may contain stale entries
+        self.queue = []
+        # highest hit pk seen so far; new HITs always have a higher pk
+        self.last_pk = 0
+
+    def __len__(self):
+        return len(self.hits)
+
+    def add(self, pk, when=None):
+        """Schedule a newly found HIT, to be checked right away by default"""
+        if pk in self.hits:
+            return
+        when = when or time.time()
+        self.hits[pk] = [when, self.min_interval]
+        heapq.heappush(self.queue, (when, pk))
+        self.last_pk = max(self.last_pk, pk)
+
+    def remove(self, pk):
+        self.hits.pop(pk, None)
+
+    def due(self, now=None):
+        """Get the pks of all HITs that are due for a check"""
+        now = now or time.time()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            when, pk = heapq.heappop(self.queue)
+            # skip entries for removed or rescheduled HITs
+            if pk in self.hits and self.hits[pk][0] == when:
+                due.append(pk)
+        return due
+
+    def next_check(self):
+        """Time of the earliest scheduled check, or None"""
+        while self.queue:
+            when, pk = self.queue[0]
+            if pk in self.hits and self.hits[pk][0] == when:
+                return when
+            heapq.heappop(self.queue)
+        return None
+
+    def retry(self, pk, now=None):
+        """Check the HIT again after min_interval, e.g. after a failed check"""
+        if pk not in self.hits:
+            return
+        when = (now or time.time()) + self.min_interval
+        self.hits[pk][0] = when
+        heapq.heappush(self.queue, (when, pk))
+
+    def checked(self, snapshot, new_results, now=None):
+        """Schedule the next check of a HIT given what its latest snapshot showed"""
+        now = now or time.time()
+        pk = snapshot.hit.pk
+        if not snapshot.hit.is_active:
+            self.remove(pk)
+            return
+        interval = self.hits.get(pk, [now, self.min_interval])[1]
+        if new_results or self.nearly_complete(snapshot):
+            interval = self.min_interval
+        else:
+            interval = min(interval * 2, self.max_interval)
+
+        when = now + interval
+        expires = self.expiration(snapshot)
+        if expires is not None:
+            # check right after the HIT expires, but not more often than min_interval
+            when = min(when, max(expires + 1, now + self.min_interval))
+        self.hits[pk] = [when, interval]
+        heapq.heappush(self.queue, (when, pk))
+
+    def nearly_complete(self, snapshot):
+        """At least half of the HIT's assignments are in, but not all of them"""
+        try:
+            max_assignments = int(snapshot.info.MaxAssignments)
+        except (AttributeError, ValueError):
+            return False
+        submitted = snapshot.submitted
+        return 0 < submitted < max_assignments and submitted * 2 >= max_assignments
+
+    def expiration(self, snapshot):
+        """The HIT's expiration as a unix timestamp, or None if unknown"""
+        try:
+            expires = datetime.datetime.strptime(snapshot.info.Expiration, '%Y-%m-%dT%H:%M:%SZ')
+        except (AttributeError, ValueError):
+            return None
+        return time.time() + (expires - datetime.datetime.utcnow()).total_seconds()
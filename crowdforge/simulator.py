@@ -0,0 +1,239 @@
+"""
+In-process simulation of Mechanical Turk, for driving flows offline.
+
+Set MTURK_BACKEND = 'crowdforge.simulator.SimulatedConnection' in settings.py
+and every AMT call made through crowdforge.utils goes to the simulator
+instead. Workers arrive at each HIT at a configurable rate, take a random
+time to submit, stop coming when the HIT expires, and the simulated service
+can fail a fraction of the calls. Time is virtual: it only moves when
+advance() is called, so thousands of HITs can be run through in seconds.
+
+The simulator lives in the current process only; it is meant for tests,
+benchmarks and scripts that create HITs and poll in the same process.
+
+    from crowdforge import simulator
+    sim = simulator.install(simulator.SimulatedMTurk(arrival_rate=1/60.0))
+    ... create a problem, run the poll command ...
+    sim.advance(600)
+"""
+from boto.exception import BotoServerError
+import datetime
+import random
+import re
+import threading
+import time
+
+import settings
+
+class Record(object):
+    """Stands in for the objects boto builds out of AMT responses"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class ResultList(list):
+    """A list of results with paging attributes, like boto's ResultSet"""
+
+class SimulatedHit(object):
+    def __init__(self, hit_id, hit_type_id, created, params, submissions):
+        self.hit_id = hit_id
+        self.hit_type_id = hit_type_id
+        self.created = created
+        self.params = params
+        self.lifetime = params['lifetime']
+        self.max_assignments = params['max_assignments']
+        # list of (submit time, assignment id, worker id), sorted by time
+        self.submissions = submissions
+        # assignment id: answers, filled in when first submitted
+        self.answers = {}
+
+    @property
+    def expiration(self):
+        return self.created + self.lifetime
+
+class SimulatedMTurk(object):
+    """
+    The state of the simulated service.
+
+    arrival_rate: workers per second picking up an assignment of a HIT
+    latency: (min, max) seconds a worker takes to submit
+    abandon_rate: fraction of workers that never submit
+    error_rate: fraction of calls that fail with a server error
+    answer: function(title, external_url, worker_id) -> dict of answers;
+            defaults to filling in the HIT's form, see form_answers
+    """
+    def __init__(self, arrival_rate=1/60.0, latency=(30, 300), abandon_rate=0.0, error_rate=0.0,
+            answer=None, seed=None, start=None):
+        self.arrival_rate = arrival_rate
+        self.latency = latency
+        self.abandon_rate = abandon_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.answer = answer or self.form_answers
+        self.now = start or time.time()
+        self.hits = {}
+        self.notifications = {}
+        # operation name: number of calls
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def advance(self, seconds):
+        """Move the simulated clock forward"""
+        with self.lock:
+            self.now += seconds
+
+    def call(self, operation):
+        """Count a call and fail it if the dice say so"""
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            failed = self.random.random() < self.error_rate
+        if failed:
+            raise BotoServerError(503, 'Service Unavailable',
+                '<Errors><Error><Code>ServiceUnavailable</Code></Error></Errors>')
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def create_hit(self, params):
+        with self.lock:
+            hit_id = 'SIM%06d' % (len(self.hits) + 1)
+            hit_type_id = 'SIMTYPE%d' % (abs(hash((params['title'], params['reward']))) % 10**6)
+            # workers show up one after the other until the HIT is full or expires
+            submissions = []
+            accepted = self.now
+            for i in range(params['max_assignments']):
+                accepted += self.random.expovariate(self.arrival_rate)
+                if accepted > self.now + params['lifetime']:
+                    break
+                if self.random.random() < self.abandon_rate:
+                    continue
+                submitted = accepted + self.random.uniform(*self.latency)
+                submissions.append((submitted, '%sA%d' % (hit_id, i), 'SIMWORKER%d' % self.random.randint(1, 10**4)))
+            submissions.sort()
+            hit = SimulatedHit(hit_id, hit_type_id, self.now, params, submissions)
+            self.hits[hit_id] = hit
+        return hit
+
+    def form_answers(self, title, external_url, worker_id):
+        """form_answers() with the simulator's seeded random choices"""
+        return form_answers(title, external_url, worker_id, self.random)
+
+    def get_hit(self, hit_id):
+        try:
+            return self.hits[hit_id]
+        except KeyError:
+            raise BotoServerError(400, 'Bad Request',
+                '<Errors><Error><Code>AWS.MechanicalTurk.HITDoesNotExist</Code></Error></Errors>')
+
+    def submitted(self, hit):
+        """All assignments of the HIT submitted by now"""
+        with self.lock:
+            submitted = [s for s in hit.submissions if s[0] <= self.now]
+            for submit_time, assignment_id, worker_id in submitted:
+                if assignment_id not in hit.answers:
+                    hit.answers[assignment_id] = self.answer(hit.params['title'],
+                        hit.params['external_url'], worker_id)
+        return submitted
+
+class SimulatedConnection(object):
+    """
+    Drop-in replacement for boto's MTurkConnection backed by the installed
+    SimulatedMTurk. Takes (and ignores) the same constructor arguments.
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @property
+    def sim(self):
+        return get_simulator()
+
+    def create_hit(self, hit_type=None, question=None, lifetime=60*60*24*7, max_assignments=1,
+            title=None, description=None, keywords=None, reward=None, duration=60*60*24*7,
+            approval_delay=None, annotation=None, **kwargs):
+        self.sim.call('CreateHIT')
+        hit = self.sim.create_hit({'title': title, 'description': description, 'reward': reward,
+            'lifetime': lifetime, 'max_assignments': max_assignments, 'duration': duration,
+            'external_url': question.external_url, 'annotation': annotation})
+        return Record(status=True, HITId=hit.hit_id, HITTypeId=hit.hit_type_id)
+
+    def get_hit(self, hit_id):
+        self.sim.call('GetHIT')
+        hit = self.sim.get_hit(hit_id)
+        now = self.sim.now
+        submitted = len(self.sim.submitted(hit))
+        return [Record(HITId=hit.hit_id, HITTypeId=hit.hit_type_id, Title=hit.params['title'],
+            MaxAssignments=str(hit.max_assignments),
+            Expiration=format_time(hit.expiration), expired=now >= hit.expiration,
+            NumberOfAssignmentsCompleted=str(submitted),
+            HITStatus=(submitted == hit.max_assignments or now >= hit.expiration) and 'Reviewable' or 'Assignable')]
+
+    def get_assignments(self, hit_id, status=None, sort_by='SubmitTime', sort_direction='Ascending',
+            page_size=10, page_number=1):
+        self.sim.call('GetAssignmentsForHIT')
+        hit = self.sim.get_hit(hit_id)
+        assignments = []
+        for submit_time, assignment_id, worker_id in self.sim.submitted(hit):
+            answers = [Record(QuestionIdentifier=k, FreeText=v) for k, v in hit.answers[assignment_id].items()]
+            assignments.append(Record(AssignmentId=assignment_id, WorkerId=worker_id, HITId=hit_id,
+                AssignmentStatus='Submitted', SubmitTime=format_time(submit_time), answers=[answers]))
+        if sort_direction == 'Descending':
+            assignments.reverse()
+        page_size, page_number = int(page_size), int(page_number)
+        page = ResultList(assignments[(page_number - 1) * page_size:page_number * page_size])
+        page.NumResults = str(len(page))
+        page.PageNumber = str(page_number)
+        page.TotalNumResults = str(len(assignments))
+        return page
+
+    def set_rest_notification(self, hit_type, url, event_types=None):
+        self.sim.call('SetHITTypeNotification')
+        self.sim.notifications[hit_type] = (url, event_types)
+        return Record(status=True)
+
+    def close(self):
+        pass
+
+def format_time(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+INPUT_RE = re.compile(r'<(input|textarea)\b([^>]*)>', re.I)
+ATTR_RE = re.compile(r'(\w+)\s*=\s*["\']([^"\']*)["\']')
+
+def form_answers(title, external_url, worker_id, rand=random):
+    """
+    Answer a HIT by filling in the form in its body: a random choice for
+    each radio button group and some text for every other field.
+    Looks the HIT up in the database by the id in its external URL.
+    """
+    from crowdforge.models import Hit
+    hit_pk = re.search(r'/hit/(\d+)/', external_url).group(1)
+    body = Hit.objects.get(pk=hit_pk).body
+    answers = {}
+    choices = {}
+    for tag, attrs in INPUT_RE.findall(body):
+        attrs = dict([(k.lower(), v) for k, v in ATTR_RE.findall(attrs)])
+        name = attrs.get('name')
+        kind = attrs.get('type', 'text').lower()
+        if not name or kind in ('hidden', 'submit', 'button'):
+            continue
+        if kind in ('radio', 'checkbox'):
+            choices.setdefault(name, []).append(attrs.get('value', 'on'))
+        else:
+            answers[name] = '%s by %s' % (name, worker_id)
+    for name in sorted(choices):
+        answers[name] = rand.choice(choices[name])
+    return answers
+
+# the simulator used by SimulatedConnection
+simulator = None
+
+def get_simulator():
+    global simulator
+    if simulator is None:
+        simulator = SimulatedMTurk(**getattr(settings, 'MTURK_SIMULATOR', {}))
+    return simulator
+
+def install(sim):
+    """Make SimulatedConnection use the given SimulatedMTurk"""
+    global simulator
+    simulator = sim
+    return sim
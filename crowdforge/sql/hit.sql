@@ -0,0 +1,2 @@
+-- Active HITs for the current stage of a problem are looked up on every poll
+CREATE INDEX crowdforge_hit_problem_stage_active ON crowdforge_hit (problem_id, hit_type_id, is_active);
@@ -0,0 +1,9 @@
+-- Indexes for the poll and flow hot queries, for databases created before
+-- they were added to the models. New databases get them from syncdb.
+--
+-- The unique index on crowdforge_result.assignment_id fails if there are
+-- duplicate results for an assignment; delete all but the first one first.
+CREATE INDEX crowdforge_problem_is_active ON crowdforge_problem (is_active);
+CREATE INDEX crowdforge_hit_is_active ON crowdforge_hit (is_active);
+CREATE INDEX crowdforge_hit_problem_stage_active ON crowdforge_hit (problem_id, hit_type_id, is_active);
+CREATE UNIQUE INDEX crowdforge_result_assignment_id ON crowdforge_result (assignment_id);
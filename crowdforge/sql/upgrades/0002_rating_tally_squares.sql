@@ -0,0 +1,7 @@
+-- Sum of squared ratings for the confidence intervals of partition ratings,
+-- for databases whose crowdforge_ratingtally table predates it.
+--
+-- The existing tallies are dropped; they are rebuilt from the vote results
+-- the next time a problem's ratings are read.
+ALTER TABLE crowdforge_ratingtally ADD COLUMN total_squares double precision NOT NULL DEFAULT 0;
+DELETE FROM crowdforge_ratingtally;
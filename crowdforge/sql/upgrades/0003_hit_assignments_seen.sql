@@ -0,0 +1,4 @@
+-- High-water mark of the assignments stored for each HIT, for databases
+-- whose crowdforge_hit table predates it. Existing HITs start at 0 and
+-- fetch all of their assignments once.
+ALTER TABLE crowdforge_hit ADD COLUMN assignments_seen integer NOT NULL DEFAULT 0;
@@ -0,0 +1,10 @@
+-- Whether a map HIT's reduce HIT was made, for databases whose
+-- crowdforge_hit table predates it. The map HITs of problems that are past
+-- their map stage are marked reduced.
+--
+-- Apply it while no problem of a pipelined flow is in its map stage: their
+-- map HITs that already have a reduce HIT would get a second one.
+ALTER TABLE crowdforge_hit ADD COLUMN is_reduced boolean NOT NULL DEFAULT false;
+UPDATE crowdforge_hit SET is_reduced = true WHERE id IN (SELECT h.id FROM crowdforge_hit h
+    JOIN crowdforge_problem p ON h.problem_id = p.id AND h.hit_type_id = p.mapper_id
+    WHERE NOT p.is_active OR p.stage_id <> p.mapper_id);
@@ -0,0 +1,132 @@
+"""
+Incremental maintenance of ProblemStats, StageStats and RatingTally.
+
+Counters are updated with F() expressions so that concurrent writers don't
+lose increments. rebuild() and rebuild_tallies() recompute everything from
+the raw rows and are used the first time stats are read for a problem that
+has none yet.
+"""
+from django.db.models import Count, F, Max, Min, Sum
+
+from crowdforge.models import Hit, ProblemStats, RatingTally, Result, StageStats
+from crowdforge.ratings import RatingMatrix
+
+def get_stats(problem):
+    """Get the stats row for the problem, building it if it doesn't exist yet"""
+    try:
+        return ProblemStats.objects.get(problem=problem)
+    except ProblemStats.DoesNotExist:
+        return rebuild(problem)
+        
+def get_stage_stats(problem):
+    """
+    Get the per-stage stats for the problem as a dict of HitType id: StageStats.
+    These only exist once get_stats has been called for the problem.
+    """
+    return dict([(s.stage_id, s) for s in StageStats.objects.filter(problem=problem)])
+
+def rebuild(problem):
+    """Recompute the stats for the problem from its results and HITs"""
+    stats, created = ProblemStats.objects.get_or_create(problem=problem)
+    results = Result.objects.filter(hit__problem=problem)
+    totals = results.aggregate(count=Count('id'), cost=Sum('hit__hit_type__payment'), 
+        first=Min('created'), last=Max('created'))
+    stats.result_count = totals['count']
+    stats.cost = totals['cost'] or 0
+    stats.first_result = totals['first']
+    stats.last_result = totals['last']
+    stats.active_hits = Hit.objects.filter(problem=problem, is_active=True).count()
+    stats.save()
+    
+    StageStats.objects.filter(problem=problem).delete()
+    stages = results.values('hit__hit_type').annotate(count=Count('id'), cost=Sum('hit__hit_type__payment'))
+    for stage in stages:
+        StageStats.objects.create(problem=problem, stage_id=stage['hit__hit_type'], 
+            result_count=stage['count'], cost=stage['cost'] or 0)
+    return stats
+    
+def record_results(hit, results):
+    """Add newly retrieved (and already saved) results for the HIT to the totals"""
+    if not results:
+        return
+    count = len(results)
+    cost = count * hit.hit_type.payment
+    first = min([r.created for r in results])
+    last = max([r.created for r in results])
+    
+    stats = ProblemStats.objects.filter(problem=hit.problem_id)
+    if not stats.update(result_count=F('result_count') + count, cost=F('cost') + cost, last_result=last):
+        # no stats yet; building them from scratch counts the new results too
+        rebuild(hit.problem)
+        return
+    stats.filter(first_result__isnull=True).update(first_result=first)
+    
+    stage_stats = StageStats.objects.filter(problem=hit.problem_id, stage=hit.hit_type_id)
+    if not stage_stats.update(result_count=F('result_count') + count, cost=F('cost') + cost):
+        StageStats.objects.create(problem_id=hit.problem_id, stage_id=hit.hit_type_id, 
+            result_count=count, cost=cost)
+        
+def record_hits_created(problem, count):
+    """Add newly created (and already saved) HITs to the active HIT count"""
+    if not ProblemStats.objects.filter(problem=problem).update(active_hits=F('active_hits') + count):
+        rebuild(problem)
+    
+def record_hit_retired(hit):
+    ProblemStats.objects.filter(problem=hit.problem_id).update(active_hits=F('active_hits') - 1)
+    
+def refresh_active_hits(problem):
+    """Recount the active HITs of the problem"""
+    active_hits = Hit.objects.filter(problem=problem, is_active=True).count()
+    if not ProblemStats.objects.filter(problem=problem).update(active_hits=active_hits):
+        rebuild(problem)
+        
+def record_votes(problem, stage, results):
+    """
+    Add the ratings in newly retrieved vote results to the tallies. Each vote
+    result is a dict of partition Result id: rating.
+    """
+    matrix = RatingMatrix.from_results(results)
+    if not matrix.items:
+        return
+    # ignore votes for results that don't exist
+    known = set(Result.objects.filter(pk__in=matrix.items).values_list('id', flat=True))
+    votes = zip(matrix.items, matrix.totals(), matrix.squares(), matrix.counts())
+    for partition_id, total, squares, count in votes:
+        if partition_id not in known:
+            continue
+        total, squares, count = float(total), float(squares), int(count)
+        tallies = RatingTally.objects.filter(problem=problem, stage=stage, partition=partition_id)
+        if not tallies.update(total=F('total') + total, total_squares=F('total_squares') + squares, 
+                count=F('count') + count):
+            RatingTally.objects.create(problem=problem, stage=stage, partition_id=partition_id, 
+                total=total, total_squares=squares, count=count)
+    
+def rebuild_tallies(problem, stage):
+    """Recompute the tallies of a voting stage from its results"""
+    RatingTally.objects.filter(problem=problem, stage=stage).delete()
+    record_votes(problem, stage, Result.objects.filter(hit__problem=problem, hit__hit_type=stage))
+    
+def ranked_tallies(problem, stage):
+    """The tallies of a voting stage, best rated first"""
+    return RatingTally.objects.filter(problem=problem, stage=stage).extra(
+        select={'rating': 'total / count'}, order_by=['-rating', 'partition'])
+    
+def get_tallies(problem, stage):
+    """
+    The tallies of a voting stage along with their partitions and the
+    partitions' HITs, best rated first, in one query. Built from the results
+    if there are none yet.
+    """
+    tallies = list(ranked_tallies(problem, stage).select_related('partition__hit'))
+    if not tallies:
+        rebuild_tallies(problem, stage)
+        tallies = list(ranked_tallies(problem, stage).select_related('partition__hit'))
+    return tallies
+    
+def get_top_rated(problem, stage):
+    """The tally of the best rated partition of a voting stage, or None if there are no votes"""
+    top = list(ranked_tallies(problem, stage).select_related('partition')[:1])
+    if not top:
+        rebuild_tallies(problem, stage)
+        top = list(ranked_tallies(problem, stage).select_related('partition')[:1])
+    return top and top[0] or None
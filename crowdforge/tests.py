@@ -5,7 +5,19 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import simplejson as json
+import os
+import shutil
+import tempfile
+import threading
+
+from crowdforge.models import *
+from crowdforge import codec, stats, utils
+from crowdforge.utils import ConnectionPool, HitSnapshot, get_snapshot, create_hits
+from crowdforge.schedule import HitSchedule
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +26,167 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class Record(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class FakeConnection(object):
+    """Stands in for MTurkConnection, counting the calls made to it"""
+    closed = False
+    
+    def __init__(self, hits=None):
+        # HITId: (HIT info, list of assignments)
+        self.hits = hits or {}
+        self.calls = []
+        self.lock = threading.Lock()
+        
+    def get_hit(self, hit_id):
+        self.calls.append('GetHIT')
+        return [self.hits[hit_id][0]]
+        
+    def get_assignments(self, hit_id, sort_by='SubmitTime', sort_direction='Ascending', page_size=10, page_number=1):
+        self.calls.append('GetAssignmentsForHIT')
+        assignments = self.hits[hit_id][1]
+        page = Page(assignments[(page_number - 1) * page_size:page_number * page_size])
+        page.TotalNumResults = str(len(assignments))
+        return page
+        
+    def create_hit(self, **kwargs):
+        self.calls.append('CreateHIT')
+        with self.lock:
+            hit_id = 'NEW%d' % len(self.hits)
+            self.hits[hit_id] = (Record(MaxAssignments=str(kwargs['max_assignments']), expired=False), [])
+        return Record(status=True, HITId=hit_id)
+    
+    def close(self):
+        self.closed = True
+
+class Page(list):
+    pass
+
+class FakePool(ConnectionPool):
+    def __init__(self, size=None, conn_factory=FakeConnection):
+        ConnectionPool.__init__(self, size)
+        self.conn_factory = conn_factory
+        
+    def new_connection(self):
+        return self.conn_factory()
+
+def assignment(assignment_id, **answers):
+    answer_set = [Record(QuestionIdentifier=k, FreeText=v) for k, v in answers.items()]
+    return Record(AssignmentId=assignment_id, answers=[answer_set])
+    
+class SandboxMixin(object):
+    """Lets a test change settings and module globals that are put back once it's done"""
+    def patch(self, obj, **values):
+        for name, value in values.items():
+            if hasattr(obj, name):
+                self.addCleanup(setattr, obj, name, getattr(obj, name))
+            else:
+                self.addCleanup(delattr, obj, name)
+            setattr(obj, name, value)
+            
+    def sandbox(self, pool):
+        """
+        Route crowdforge.utils through the connection pool, and don't let poll
+        and polld flush metrics into the real metrics file, or big payloads
+        into the real blob store
+        """
+        blob_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, blob_root)
+        # crowdforge.utils reads the settings module directly
+        self.patch(utils.settings, METRICS_FILE=None, BLOB_ROOT=blob_root)
+        self.patch(utils, connection_pool=pool)
+        codec.results.clear()
+        
+class FakeMTurkMixin(SandboxMixin):
+    """Routes crowdforge.utils through a FakeConnection"""
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.sandbox(FakePool(conn_factory=lambda: self.conn))
+        self.problem = Problem.objects.create(name='test', flow=FlowType.objects.get(name='SimpleFlow'),
+            partition=HitType.objects.get(pk=1), mapper=HitType.objects.get(pk=2), 
+            reducer=HitType.objects.get(pk=3))
+        
+    def make_hit(self, hit_id, max_assignments=1, expired=False, assignments=()):
+        hit = Hit.objects.create(hit_id=hit_id, hit_type=self.problem.partition, problem=self.problem,
+            title='title', description='description', body='body')
+        info = Record(MaxAssignments=str(max_assignments), expired=expired)
+        self.conn.hits[hit_id] = (info, list(assignments))
+        return hit
+
+class FakeMTurkTestCase(FakeMTurkMixin, TestCase):
+    pass
+
+class ConnectionPoolTest(TestCase):
+    def test_reuse(self):
+        pool = FakePool(size=2)
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            pass
+        self.assertTrue(first is second)
+        self.assertEqual(pool.stats(), {'opened': 1, 'reused': 1, 'idle': 1})
+        
+    def test_overflow_is_closed(self):
+        pool = FakePool(size=1)
+        a = pool.acquire()
+        b = pool.acquire()
+        pool.release(a)
+        pool.release(b)
+        self.assertEqual(pool.opened, 2)
+        self.assertFalse(a.closed)
+        self.assertTrue(b.closed)
+        
+class SnapshotTest(FakeMTurkTestCase):
+    def test_two_calls_per_hit(self):
+        hit = self.make_hit('H1', max_assignments=2, assignments=[assignment('A1', item1='intro')])
+        snapshot = get_snapshot(hit)
+        self.assertEqual(self.conn.calls, ['GetHIT', 'GetAssignmentsForHIT'])
+        
+        results = snapshot.save_results()
+        self.assertEqual(len(results), 1)
+        self.assertFalse(snapshot.is_expired())
+        self.assertFalse(snapshot.is_complete())
+        self.assertEqual(len(self.conn.calls), 2)
+        
+    def test_complete(self):
+        hit = self.make_hit('H1', assignments=[assignment('A1', fact='x')])
+        snapshot = get_snapshot(hit)
+        snapshot.save_results()
+        self.assertTrue(snapshot.is_complete())
+        self.assertFalse(Hit.objects.get(pk=hit.pk).is_active)
+        # results are only stored once
+        self.assertEqual(get_snapshot(hit).save_results(), [])
+        
+    def test_only_new_assignments_are_saved(self):
+        hit = self.make_hit('H1', max_assignments=3, assignments=[assignment('A1', fact='x')])
+        first = get_snapshot(hit).save_results()
+        self.conn.hits['H1'][1].extend([assignment('A2', fact='y'), assignment('A3', fact='z')])
+        
+        results = get_snapshot(hit).save_results()
+        self.assertEqual([r.assignment_id for r in results], ['A2', 'A3'])
+        self.assertTrue(results[0].id > first[0].id)
+        self.assertEqual(json.loads(results[1].value), {'fact': 'z'})
+        self.assertEqual(Result.objects.filter(hit=hit).count(), 3)
+        
+    def test_pages(self):
+        hit = self.make_hit('H1', max_assignments=250,
+            assignments=[assignment('A%d' % i, fact=str(i)) for i in range(150)])
+        snapshot = get_snapshot(hit)
+        self.assertEqual(self.conn.calls, ['GetHIT', 'GetAssignmentsForHIT', 'GetAssignmentsForHIT'])
+        self.assertEqual(len(snapshot.save_results()), 150)
+        self.assertEqual(Hit.objects.get(pk=hit.pk).assignments_seen, 150)
+        
+        # the next poll starts at the page holding the first new assignment
+        self.conn.hits['H1'][1].extend([assignment('A%d' % i, fact=str(i)) for i in range(150, 250)])
+        self.conn.calls = []
+        snapshot = get_snapshot(Hit.objects.get(pk=hit.pk))
+        self.assertEqual(self.conn.calls, ['GetHIT', 'GetAssignmentsForHIT', 'GetAssignmentsForHIT'])
+        self.assertEqual(len(snapshot.assignments), 150)
+        self.assertEqual([r.assignment_id for r in snapshot.save_results()], ['A%d' % i for i in range(150, 250)])
+        self.assertTrue(snapshot.is_complete())
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
@@ -21,3 +194,1021 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+class PollTest(FakeMTurkTestCase):
+    def test_workers_fan_out_map_stage(self):
+        self.problem.stage = self.problem.partition
+        self.problem.save()
+        self.make_hit('H1', assignments=[assignment('A1', item1='History', item2='Sports')])
+        self.make_hit('H2', expired=True)
+        
+        # flows registers itself in the database on import
+        from crowdforge.management.commands.poll import Command as PollCommand
+        PollCommand().post_notifications(workers=2)
+        self.assertEqual(Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper).count(), 2)
+        self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, self.problem.mapper)
+
+    def test_stalled_problems_in_one_query(self):
+        from crowdforge import notifications
+        busy = []
+        for i in range(5):
+            problem = Problem.objects.create(name='busy %d' % i, flow=self.problem.flow, stage=self.problem.mapper,
+                partition=self.problem.partition, mapper=self.problem.mapper, reducer=self.problem.reducer)
+            Hit.objects.create(hit_id='B%d' % i, hit_type=self.problem.mapper, problem=problem,
+                title='map', description='map', body='')
+            busy.append(problem)
+        # an active HIT from an earlier stage doesn't hold up the current one
+        done = busy.pop()
+        done.stage = self.problem.reducer
+        done.save()
+        
+        self.patch(settings, DEBUG=True)
+        connection.queries = []
+        stalled = list(notifications.get_stalled_problems())
+        stalled[0].flow.name, stalled[0].stage
+        self.assertEqual(len(connection.queries), 1)
+        self.assertEqual([p.pk for p in stalled], [self.problem.pk, done.pk])
+        self.assertEqual(list(notifications.get_stalled_problems([done.pk, busy[0].pk])), [done])
+        
+        from crowdforge.management.commands.poll import Command as PollCommand
+        PollCommand().post_notifications()
+        # the unstarted problem started, the one without reduce HITs finished
+        self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, self.problem.partition)
+        self.assertFalse(Problem.objects.get(pk=done.pk).is_active)
+        self.assertTrue(Problem.objects.get(pk=busy[0].pk).is_active)
+
+    def test_idle_hits_cost_no_queries(self):
+        from crowdforge.management.commands.poll import Command as PollCommand
+        self.problem.stage = self.problem.partition
+        self.problem.save()
+        self.patch(settings, DEBUG=True)
+        counts = []
+        for i in range(2):
+            for j in range(5 * i, 5 * (i + 1)):
+                self.make_hit('H%d' % j)
+            connection.queries = []
+            PollCommand().post_notifications()
+            counts.append(len(connection.queries))
+        self.assertEqual(counts[0], counts[1])
+
+class CreateHitsTest(FakeMTurkTestCase):
+    def test_bulk_create(self):
+        params = [{'topic': 'topic %d' % i} for i in range(20)]
+        hits = create_hits(self.problem, self.problem.mapper, params, workers=4)
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 20)
+        
+        rows = Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper)
+        self.assertEqual(sorted(rows.values_list('id', flat=True)), sorted([hit.id for hit in hits]))
+        self.assertEqual(sorted(rows.values_list('hit_id', flat=True)), sorted(self.conn.hits.keys()))
+        self.assertEqual(Hit.objects.get(pk=hits[3].pk).title, self.problem.mapper.title % params[3])
+
+    def fail_posts(self, *errors):
+        errors = list(errors)
+        create_hit = self.conn.create_hit
+        def failing_create_hit(**kwargs):
+            if errors:
+                self.conn.calls.append('CreateHIT')
+                raise errors.pop(0)
+            return create_hit(**kwargs)
+        self.conn.create_hit = failing_create_hit
+        
+    def test_throttled_posts_are_retried(self):
+        from boto.exception import BotoServerError
+        self.fail_posts(BotoServerError(503, 'Service Unavailable'))
+        hit = create_hits(self.problem, self.problem.mapper, [{'topic': 'a'}])[0]
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 2)
+        self.assertEqual(Hit.objects.get(pk=hit.pk).hit_id, 'NEW0')
+        
+    def test_timeouts_are_not_retried(self):
+        import socket
+        self.fail_posts(socket.timeout('timed out'))
+        self.assertRaises(socket.timeout, create_hits, self.problem, self.problem.mapper, [{'topic': 'a'}])
+        # the HIT may exist on AMT, so it's neither posted again nor left to hold up the stage
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 1)
+        hit = Hit.objects.get(problem=self.problem)
+        self.assertFalse(hit.is_active)
+        self.assertEqual(utils.post_pending_hits(Hit.objects.all()), [])
+        
+    def test_failed_notification_registration(self):
+        self.patch(utils.settings, MTURK_NOTIFICATIONS=True)
+        def set_rest_notification(*args, **kwargs):
+            raise RuntimeError('no notifications')
+        self.conn.set_rest_notification = set_rest_notification
+        self.conn.create_hit = lambda create_hit=self.conn.create_hit, **kwargs: \
+            Record(HITTypeId='T1', **create_hit(**kwargs).__dict__)
+        hit = create_hits(self.problem, self.problem.mapper, [{'topic': 'a'}])[0]
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 1)
+        self.assertEqual(Hit.objects.get(pk=hit.pk).hit_id, 'NEW0')
+
+class ProblemViewTest(FakeMTurkTestCase):
+    def setUp(self):
+        FakeMTurkTestCase.setUp(self)
+        self.patch(settings, DEBUG=True, 
+            TEMPLATE_DIRS=(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates'),))
+        
+    def count_queries(self):
+        connection.queries = []
+        response = self.client.get('/turk/problem/%d/' % self.problem.pk)
+        self.assertEqual(response.status_code, 200)
+        return len(connection.queries), response
+        
+    def add_results(self, hit, count):
+        self.conn.hits[hit.hit_id][1].extend([assignment('%s-%d' % (hit.hit_id, i), fact='f') 
+            for i in range(count)])
+        get_snapshot(hit).save_results()
+        
+    def test_constant_queries(self):
+        self.add_results(self.make_hit('H1'), 2)
+        few, response = self.count_queries()
+        self.assertEqual(response.context['number'], 2)
+        
+        for i in range(10):
+            self.add_results(self.make_hit('M%d' % i), 3)
+        many, response = self.count_queries()
+        self.assertEqual(few, many)
+        self.assertEqual(response.context['number'], 32)
+        self.assertAlmostEqual(response.context['cost'], 32 * self.problem.partition.payment)
+        
+class HitPageTest(FakeMTurkTestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        FakeMTurkTestCase.setUp(self)
+        self.patch(settings, DEBUG=True, 
+            TEMPLATE_DIRS=(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates'),))
+        # ids are reused between tests
+        cache.clear()
+        
+    def get(self, hit, **params):
+        connection.queries = []
+        response = self.client.get('/turk/hit/%d/' % hit.pk, params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(connection.queries)
+        
+    def test_cached_page(self):
+        hit = create_hits(self.problem, self.problem.mapper, [{'topic': 'History'}])[0]
+        response, queries = self.get(hit, assignmentId='A"1', turkSubmitTo='https://www.mturk.com')
+        self.assertTrue('History' in response.content)
+        self.assertTrue('value="A&quot;1"' in response.content)
+        self.assertTrue('action="https://www.mturk.com/mturk/externalSubmit"' in response.content)
+        self.assertEqual(queries, 1)
+        
+        # only the request specific parts change, without going to the database
+        response, queries = self.get(hit, assignmentId='A2')
+        self.assertTrue('value="A2"' in response.content)
+        self.assertTrue('action="http://workersandbox.mturk.com/mturk/externalSubmit"' in response.content)
+        self.assertEqual(queries, 0)
+        
+        hit.body = 'changed'
+        hit.save()
+        response, queries = self.get(hit)
+        self.assertTrue('changed' in response.content)
+        
+    def test_missing_hit(self):
+        self.assertEqual(self.client.get('/turk/hit/12345/').status_code, 404)
+        
+    def test_conditional_get(self):
+        hit = create_hits(self.problem, self.problem.mapper, [{'topic': 'History'}])[0]
+        response, queries = self.get(hit, assignmentId='A1')
+        etag, modified = response['ETag'], response['Last-Modified']
+        self.assertTrue('max-age' in response['Cache-Control'])
+        
+        connection.queries = []
+        url = '/turk/hit/%d/' % hit.pk
+        response = self.client.get(url, {'assignmentId': 'A1'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, {'assignmentId': 'A1'}, HTTP_IF_MODIFIED_SINCE=modified)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(connection.queries), 0)
+        
+        # another assignment gets its own version of the page
+        response = self.client.get(url, {'assignmentId': 'A2'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        
+    def test_renderer(self):
+        from crowdforge.renderers import compile_format, get_renderer
+        params = {'topic': 'History', 'list': '<li>a</li>'}
+        for format in ('%(topic)s', 'plain', 'a %(topic)s b %(list)s c', '100%% %(topic)s', '%(topic)r'):
+            self.assertEqual(compile_format(format)(params), format % params)
+        self.assertRaises(KeyError, compile_format('%(missing)s'), params)
+        
+        hit_type = self.problem.mapper
+        renderer = get_renderer(hit_type)
+        self.assertTrue(get_renderer(hit_type) is renderer)
+        hit_type.title = 'Facts about %(topic)s'
+        hit_type.save()
+        self.assertEqual(get_renderer(hit_type).render(params)[0], 'Facts about History')
+        # an edit made elsewhere is noticed from the content
+        stale = HitType.objects.get(pk=hit_type.pk)
+        stale.title = 'More about %(topic)s'
+        self.assertEqual(get_renderer(stale).render(params)[0], 'More about History')
+
+class BlobStoreTest(FakeMTurkTestCase):
+    def test_big_payloads_are_stored_once(self):
+        from crowdforge import blobstore
+        facts = ''.join(['<li>fact %d</li>' % i for i in range(200)])
+        hits = create_hits(self.problem, self.problem.reducer, [{'topic': 'a', 'list': facts}] * 2 + [{'topic': 'b', 'list': ''}])
+        refs = list(Hit.objects.filter(pk__in=[h.pk for h in hits]).order_by('id').values_list('params_ref', flat=True))
+        self.assertTrue(refs[0].startswith(blobstore.PREFIX))
+        self.assertEqual(refs[0], refs[1])
+        self.assertEqual(refs[2], json.dumps({'topic': 'b', 'list': ''}))
+        self.assertEqual(json.loads(Hit.objects.get(pk=hits[0].pk).params)['list'], facts)
+        self.assertEqual(len(os.listdir(os.path.join(utils.settings.BLOB_ROOT, refs[0][len(blobstore.PREFIX):][:2]))), 1)
+        
+    def test_blobs_are_readable_by_others(self):
+        from crowdforge import blobstore
+        umask = os.umask(022)
+        try:
+            key = blobstore.put(u'x' * 5000)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(blobstore.get_path(key)).st_mode & 0777, 0644)
+        self.assertEqual(os.listdir(os.path.dirname(blobstore.get_path(key))), [key[2:]])
+        
+    def test_pack(self):
+        from crowdforge import blobstore
+        self.assertEqual(blobstore.pack(u'small'), u'small')
+        # short values that look like references are stored too
+        looks_like_ref = blobstore.PREFIX + 'not really'
+        self.assertNotEqual(blobstore.pack(looks_like_ref), looks_like_ref)
+        for text in (u'small', looks_like_ref, u'\u00e9' * 5000, '', None):
+            self.assertEqual(blobstore.unpack(blobstore.pack(text)), text)
+            
+    def test_poll_defers_payloads(self):
+        from crowdforge.management.commands.poll import Command as PollCommand
+        hit = self.make_hit('H1', assignments=[assignment('A1', item1='History')])
+        queries = []
+        old_process = PollCommand.fetch_snapshots
+        def fetch_snapshots(command, hits, workers=1):
+            queries.append(str(hits.query))
+            return old_process(command, hits, workers)
+        self.patch(PollCommand, fetch_snapshots=fetch_snapshots)
+        PollCommand().post_notifications()
+        self.assertFalse('"body"' in queries[0] or '"params"' in queries[0])
+        self.assertFalse(Hit.objects.get(pk=hit.pk).is_active)
+
+class ResultCacheTest(FakeMTurkTestCase):
+    def make_result(self, assignment_id, data):
+        hit = self.make_hit('H-' + assignment_id)
+        return Result.objects.create(assignment_id=assignment_id, hit=hit, value=json.dumps(data))
+        
+    def test_parsed_once(self):
+        result = self.make_result('A1', {'item1': 'History'})
+        self.assertEqual(Result.objects.get(pk=result.pk).data, {'item1': 'History'})
+        self.assertEqual(Result.objects.get(pk=result.pk).data, {'item1': 'History'})
+        self.assertEqual((codec.results.hits, codec.results.misses), (1, 1))
+        
+    def test_changed_value(self):
+        result = self.make_result('A1', {'item1': 'History'})
+        result.data
+        Result.objects.filter(pk=result.pk).update(value_ref=json.dumps({'item1': 'Sports'}))
+        self.assertEqual(Result.objects.get(pk=result.pk).data, {'item1': 'Sports'})
+        
+    def test_bounded(self):
+        cache = codec.ValueCache(size=2)
+        for id in (1, 2, 1, 3):
+            cache.parse(id, json.dumps(id))
+        # 2 was the least recently used
+        self.assertEqual(list(cache.entries), [1, 3])
+        
+    def test_codec(self):
+        import json as std_json
+        self.patch(utils.settings, JSON_CODEC='json')
+        self.assertEqual(codec.loads('{"a": [1]}'), {'a': [1]})
+        self.assertTrue(codec.get_decoder() is std_json.loads)
+
+class LeaseTest(FakeMTurkTestCase):
+    def make_problems(self, count):
+        return [self.problem.pk] + [Problem.objects.create(name='test %d' % i, flow=self.problem.flow,
+            partition=self.problem.partition, mapper=self.problem.mapper, reducer=self.problem.reducer).pk
+            for i in range(count - 1)]
+    
+    def test_pollers_share_problems(self):
+        from crowdforge import leases
+        problems = self.make_problems(4)
+        self.assertEqual(sorted(leases.claim('a', 60)), problems)
+        # b only gets problems once a gives some back
+        self.assertEqual(leases.claim('b', 60), [])
+        self.assertEqual(leases.claim('a', 60), problems[:2])
+        self.assertEqual(leases.claim('b', 60), problems[2:])
+        self.assertFalse(leases.renew(problems[0], 'b', 60))
+        self.assertTrue(leases.renew(problems[0], 'a', 60))
+        
+        # a stops; once its leases run out b takes over
+        Lease.objects.filter(owner='a').update(expires=leases.now())
+        Poller.objects.filter(name='a').delete()
+        self.assertEqual(sorted(leases.claim('b', 60)), problems)
+        leases.release('b')
+        self.assertFalse(leases.is_held(problems[0]))
+        
+    def test_sharded_poll(self):
+        from crowdforge.management.commands.poll import Command as PollCommand
+        from crowdforge import leases
+        problems = self.make_problems(2)
+        for owner in ('other', 'me', 'other', 'me'):
+            leases.claim(owner, 60)
+        mine = Lease.objects.get(owner='me').problem
+        theirs = Lease.objects.get(owner='other').problem
+        PollCommand().post_notifications(owner='me')
+        # only my problem started; the other one isn't even started by an unsharded check
+        self.assertEqual(Problem.objects.get(pk=mine.pk).stage, self.problem.partition)
+        from crowdforge import notifications
+        notifications.check_problems()
+        self.assertEqual(Problem.objects.get(pk=theirs.pk).stage, None)
+        self.assertEqual(Hit.objects.filter(problem=mine).count(), 1)
+        self.assertFalse(Hit.objects.filter(problem=mine, hit_id__startswith='?').exists())
+        
+    def test_poll_gives_leases_back(self):
+        from crowdforge.management.commands.poll import Command as PollCommand
+        PollCommand().handle(shard=True, workers=1)
+        self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, self.problem.partition)
+        self.assertFalse(Poller.objects.exists())
+        self.assertEqual(list(Lease.objects.values_list('owner', flat=True)), [''])
+        
+    def test_unposted_hits_are_posted(self):
+        from crowdforge.management.commands.poll import Command as PollCommand
+        from crowdforge import leases
+        from crowdforge.utils import deferred_posting
+        with deferred_posting():
+            hit = create_hits(self.problem, self.problem.partition, [{}])[0]
+        self.assertTrue(Hit.objects.get(pk=hit.pk).hit_id.startswith('?'))
+        PollCommand().post_notifications(owner='me')
+        self.assertTrue(Hit.objects.get(pk=hit.pk).hit_id.startswith('NEW'))
+
+    def test_failed_posts_are_retried_without_shards(self):
+        from crowdforge.management.commands.poll import Command as PollCommand
+        from crowdforge import leases
+        from crowdforge.utils import deferred_posting
+        self.problem.stage = self.problem.partition
+        self.problem.save()
+        with deferred_posting():
+            hit, held = create_hits(self.problem, self.problem.partition, [{}, {}])
+        # the second one belongs to a problem a sharded poller holds
+        problem = Problem.objects.create(name='held', flow=self.problem.flow, partition=self.problem.partition,
+            mapper=self.problem.mapper, reducer=self.problem.reducer)
+        Hit.objects.filter(pk=held.pk).update(problem=problem)
+        leases.claim('other', 60)
+        Lease.objects.filter(problem=self.problem).update(owner='', expires=leases.now())
+        # only posted again once the poster had plenty of time
+        PollCommand().post_notifications()
+        self.assertTrue(Hit.objects.get(pk=hit.pk).hit_id.startswith('?'))
+        Hit.objects.filter(pk=hit.pk).update(hit_id='?0:old')
+        Hit.objects.filter(pk=held.pk).update(hit_id='?0:held')
+        PollCommand().post_notifications()
+        self.assertTrue(Hit.objects.get(pk=hit.pk).hit_id.startswith('NEW'))
+        self.assertEqual(Hit.objects.get(pk=held.pk).hit_id, '?0:held')
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 1)
+
+class TransitionTest(FakeMTurkMixin, TransactionTestCase):
+    def test_unsharded_transition_takes_lease(self):
+        from crowdforge import leases, notifications
+        problem = Problem.objects.get(pk=self.problem.pk)
+        self.assertTrue(notifications.advance(problem))
+        self.assertFalse(leases.is_held(problem.pk))
+        # a stale copy of the problem doesn't start it twice
+        self.assertFalse(notifications.advance(problem))
+        self.assertEqual(Hit.objects.filter(problem=problem).count(), 1)
+        
+        # nor does it run while a sharded poller holds it
+        Result.objects.create(assignment_id='A1', hit=Hit.objects.get(problem=problem),
+            value=json.dumps({'item1': 'History'}))
+        Hit.objects.update(is_active=False)
+        leases.claim('other', 60)
+        problem = Problem.objects.get(pk=self.problem.pk)
+        self.assertFalse(notifications.advance(problem))
+        self.assertEqual(Problem.objects.get(pk=problem.pk).stage, self.problem.partition)
+        self.assertTrue(notifications.advance(problem, 'other'))
+        self.assertEqual(Problem.objects.get(pk=problem.pk).stage, self.problem.mapper)
+        
+
+    def test_crash_rolls_back(self):
+        from crowdforge import flows, notifications
+        calls = []
+        class CrashingFlow(flows.SimpleFlow):
+            def start(self):
+                self.create_hit(self.problem.partition)
+                self.set_stage(self.problem.partition)
+                if not calls:
+                    calls.append(1)
+                    raise RuntimeError('crash')
+        flows.flows['SimpleFlow'] = CrashingFlow
+        try:
+            self.assertRaises(RuntimeError, notifications.check_problems)
+            self.assertEqual(Hit.objects.filter(problem=self.problem).count(), 0)
+            self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, None)
+            self.assertEqual(self.conn.calls, [])
+            notifications.check_problems()
+        finally:
+            flows.flows['SimpleFlow'] = flows.SimpleFlow
+        self.assertEqual(Hit.objects.filter(problem=self.problem).count(), 1)
+        self.assertEqual(self.conn.calls, ['CreateHIT'])
+        
+    def test_failed_post_is_left_to_poll(self):
+        from boto.exception import BotoServerError
+        from crowdforge import notifications
+        other = Problem.objects.create(name='other', flow=self.problem.flow, partition=self.problem.partition,
+            mapper=self.problem.mapper, reducer=self.problem.reducer)
+        self.patch(utils.settings, MTURK_POST_RETRIES=0)
+        create_hit = self.conn.create_hit
+        errors = [BotoServerError(503, 'Service Unavailable')]
+        def failing_create_hit(**kwargs):
+            if errors:
+                raise errors.pop(0)
+            return create_hit(**kwargs)
+        self.conn.create_hit = failing_create_hit
+        notifications.check_problems()
+        # both problems started, the HIT that failed waits for poll to post it
+        for problem in (self.problem, other):
+            self.assertEqual(Problem.objects.get(pk=problem.pk).stage, self.problem.partition)
+        hit_ids = sorted(Hit.objects.filter(is_active=True).values_list('hit_id', flat=True))
+        self.assertTrue(hit_ids[0].startswith('?'))
+        self.assertEqual(hit_ids[1], 'NEW0')
+        
+    def test_lost_lease(self):
+        from crowdforge import leases, notifications
+        from crowdforge import flows
+        leases.claim('me', 60)
+        class SlowFlow(flows.SimpleFlow):
+            def start(self):
+                self.create_hit(self.problem.partition)
+                # took too long, another poller got the problem
+                Lease.objects.filter(owner='me').update(owner='other')
+        flows.flows['SimpleFlow'] = SlowFlow
+        try:
+            self.assertFalse(notifications.advance(Problem.objects.get(pk=self.problem.pk), 'me'))
+        finally:
+            flows.flows['SimpleFlow'] = flows.SimpleFlow
+        self.assertEqual(Hit.objects.filter(problem=self.problem).count(), 0)
+        self.assertEqual(self.conn.calls, [])
+
+    def test_job_taken_over(self):
+        from crowdforge import jobs, notifications
+        self.patch(utils.settings, FLOW_JOBS=True)
+        notifications.check_problems()
+        job = jobs.claim('slow')
+        # it took too long, another worker got the job in the meantime
+        Job.objects.update(owner='other')
+        jobs.run(job)
+        self.assertEqual(Hit.objects.count(), 0)
+        self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, None)
+        self.assertEqual(list(Job.objects.values_list('owner', 'state')), [('other', Job.RUNNING)])
+
+class JobTest(FakeMTurkTestCase):
+    def setUp(self):
+        FakeMTurkTestCase.setUp(self)
+        self.patch(utils.settings, FLOW_JOBS=True)
+        
+    def test_transitions_are_queued(self):
+        from crowdforge import jobs, notifications
+        self.problem.stage = self.problem.partition
+        self.problem.save()
+        result_hit = self.make_hit('H1', assignments=[assignment('A1', item1='History', item2='Sports')])
+        from crowdforge.management.commands.poll import Command as PollCommand
+        PollCommand().post_notifications()
+        # polling only queued the transition, and queueing it again does nothing
+        self.assertEqual(Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper).count(), 0)
+        self.assertEqual(list(Job.objects.values_list('key', flat=True)), 
+            ['advance:%d:%d' % (self.problem.pk, self.problem.partition_id)])
+        notifications.check_problems()
+        self.assertEqual(Job.objects.count(), 1)
+        
+        # the transition creates the HITs and queues their posting
+        self.assertEqual(jobs.work('worker', limit=1), 1)
+        map_hits = Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper)
+        self.assertEqual(map_hits.filter(hit_id__startswith='?').count(), 2)
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 0)
+        self.assertEqual(jobs.work('worker'), 1)
+        self.assertEqual(map_hits.filter(hit_id__startswith='?').count(), 0)
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 2)
+        self.assertEqual(list(Job.objects.values_list('state', flat=True)), [Job.DONE, Job.DONE])
+        
+        # running a transition again after it happened does nothing
+        notifications.run_advance(self.problem.pk, self.problem.partition_id)
+        self.assertEqual(map_hits.count(), 2)
+        
+    def test_retries(self):
+        from crowdforge import jobs
+        calls = []
+        def flaky(n):
+            calls.append(n)
+            if len(calls) < 2:
+                raise RuntimeError('try again')
+        jobs.register('flaky', flaky)
+        self.addCleanup(jobs.handlers.pop, 'flaky')
+        self.assertTrue(jobs.enqueue('flaky', 'flaky:1', n=1))
+        self.assertFalse(jobs.enqueue('flaky', 'flaky:1', n=1))
+        self.assertEqual(jobs.work('worker'), 1)
+        job = Job.objects.get(key='flaky:1')
+        self.assertEqual((job.state, job.attempts), (Job.QUEUED, 1))
+        self.assertTrue('try again' in job.error)
+        # not due yet
+        self.assertEqual(jobs.work('worker'), 0)
+        Job.objects.update(run_after=jobs.now())
+        self.assertEqual(jobs.work('worker'), 1)
+        self.assertEqual(Job.objects.get(key='flaky:1').state, Job.DONE)
+        self.assertEqual(calls, [1, 1])
+        
+    def test_dead_worker(self):
+        from crowdforge import jobs
+        jobs.register('noop', lambda: None)
+        self.addCleanup(jobs.handlers.pop, 'noop')
+        jobs.enqueue('noop', 'noop')
+        job = jobs.claim('dead', seconds=60)
+        self.assertEqual(jobs.claim('alive'), None)
+        Job.objects.filter(pk=job.pk).update(locked_until=jobs.now())
+        self.assertEqual(jobs.claim('alive').pk, job.pk)
+
+class PipelinedFlowTest(FakeMTurkTestCase):
+    def poll(self):
+        from crowdforge.management.commands.poll import Command as PollCommand
+        PollCommand().post_notifications()
+        return Problem.objects.get(pk=self.problem.pk)
+        
+    def complete(self, hit, **answers):
+        self.conn.hits[hit.hit_id][1].append(assignment('A-%s' % hit.hit_id, **answers))
+    
+    def test_reduce_starts_per_map_hit(self):
+        from crowdforge import flows
+        self.problem.flow = FlowType.objects.get_or_create(name='PipelinedFlow')[0]
+        self.problem.stage = self.problem.mapper
+        self.problem.save()
+        flow = flows.get(self.problem)
+        slow, fast = flow.create_hits(self.problem.mapper, [{'topic': 'History'}, {'topic': 'Sports'}])
+        reduce_hits = Hit.objects.filter(problem=self.problem, hit_type=self.problem.reducer)
+        
+        self.complete(fast, fact='football')
+        self.assertEqual(self.poll().stage, self.problem.mapper)
+        self.assertEqual([json.loads(h.params) for h in reduce_hits.all()], 
+            [{'topic': 'Sports', 'list': '<li>football</li>', 'map_hit': fast.pk}])
+        
+        self.complete(slow, fact='old')
+        self.assertEqual(self.poll().stage, self.problem.reducer)
+        self.assertEqual(sorted([json.loads(h.params)['map_hit'] for h in reduce_hits.all()]), [slow.pk, fast.pk])
+        
+        for hit in reduce_hits.all():
+            self.complete(hit, paragraph='text')
+        self.assertFalse(self.poll().is_active)
+        
+    def test_same_hit_handled_twice(self):
+        from crowdforge import flows, notifications
+        self.problem.flow = FlowType.objects.get_or_create(name='PipelinedFlow')[0]
+        self.problem.stage = self.problem.mapper
+        self.problem.save()
+        hit = flows.get(self.problem).create_hits(self.problem.mapper, [{'topic': 'History'}])[0]
+        self.complete(hit, fact='old')
+        # e.g. the notify view and a poller fetched the same HIT at once
+        first, second = get_snapshot(Hit.objects.get(pk=hit.pk)), get_snapshot(Hit.objects.get(pk=hit.pk))
+        notifications.process_snapshot(first)
+        notifications.process_snapshot(second)
+        self.assertEqual(Hit.objects.filter(problem=self.problem, hit_type=self.problem.reducer).count(), 1)
+        self.assertEqual(stats.get_stats(self.problem).active_hits, 1)
+        
+    def test_missed_map_hits_are_reduced(self):
+        from crowdforge import flows
+        self.problem.flow = FlowType.objects.get_or_create(name='PipelinedFlow')[0]
+        self.problem.save()
+        flow = flows.get(self.problem)
+        map_hits = flow.create_hits(self.problem.mapper, [{'topic': 'History'}, {'topic': 'Sports'}])
+        flow.reduce_map_hit(map_hits[0])
+        # still active
+        self.assertEqual(Hit.objects.filter(problem=self.problem, hit_type=self.problem.reducer).count(), 0)
+        Hit.objects.filter(pk=map_hits[0].pk).update(is_active=False)
+        flow.reduce_map_hit(Hit.objects.get(pk=map_hits[0].pk))
+        flow.on_stage_completed(self.problem.mapper)
+        params = [json.loads(h.params) for h in Hit.objects.filter(problem=self.problem, hit_type=self.problem.reducer)]
+        self.assertEqual([p['map_hit'] for p in params], [h.pk for h in map_hits])
+        self.assertEqual(self.problem.stage, self.problem.reducer)
+
+    def test_map_hit_reduced_once(self):
+        from crowdforge import flows
+        self.problem.flow = FlowType.objects.get_or_create(name='PipelinedFlow')[0]
+        self.problem.save()
+        flow = flows.get(self.problem)
+        map_hit = flow.create_hits(self.problem.mapper, [{'topic': 'History'}])[0]
+        Hit.objects.filter(pk=map_hit.pk).update(is_active=False)
+        map_hit = Hit.objects.get(pk=map_hit.pk)
+        # the stage transition got to the map HIT before its callback did
+        flow.on_stage_completed(self.problem.mapper)
+        flow.reduce_map_hit(map_hit)
+        self.assertEqual(Hit.objects.filter(problem=self.problem, hit_type=self.problem.reducer).count(), 1)
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 2)
+        
+    def test_reduce_hits_are_queued_with_jobs(self):
+        from crowdforge import flows
+        self.patch(utils.settings, FLOW_JOBS=True)
+        self.problem.flow = FlowType.objects.get_or_create(name='PipelinedFlow')[0]
+        self.problem.save()
+        flow = flows.get(self.problem)
+        map_hit = flow.create_hits(self.problem.mapper, [{'topic': 'History'}])[0]
+        Hit.objects.filter(pk=map_hit.pk).update(is_active=False)
+        flow.reduce_map_hit(Hit.objects.get(pk=map_hit.pk))
+        reduce_hit = Hit.objects.get(problem=self.problem, hit_type=self.problem.reducer)
+        self.assertTrue(reduce_hit.hit_id.startswith('?'))
+        self.assertEqual(self.conn.calls.count('CreateHIT'), 1)
+        self.assertEqual(list(Job.objects.values_list('key', flat=True)), ['post_hits:%d' % reduce_hit.pk])
+
+class StatsTest(FakeMTurkTestCase):
+    def test_incremental_matches_rebuild(self):
+        hits = create_hits(self.problem, self.problem.mapper, [{'topic': 'a'}, {'topic': 'b'}])
+        self.conn.hits[hits[0].hit_id][1].append(assignment('A1', fact='x'))
+        self.conn.hits[hits[1].hit_id][1].append(assignment('A2', fact='y'))
+        for hit in hits:
+            snapshot = get_snapshot(hit)
+            snapshot.save_results()
+            snapshot.is_complete()
+        
+        incremental = stats.get_stats(self.problem)
+        self.assertEqual(incremental.result_count, 2)
+        self.assertEqual(incremental.active_hits, 0)
+        self.assertEqual(stats.get_stage_stats(self.problem)[self.problem.mapper_id].result_count, 2)
+        rebuilt = stats.rebuild(self.problem)
+        for field in ('result_count', 'cost', 'first_result', 'last_result', 'active_hits'):
+            self.assertEqual(getattr(incremental, field), getattr(rebuilt, field))
+
+class ReduceParamsTest(FakeMTurkTestCase):
+    def add_map_hit(self, topic, facts):
+        hit = Hit.objects.create(hit_id='M-' + topic, hit_type=self.problem.mapper, problem=self.problem,
+            params=json.dumps({'topic': topic}), title='map', description='map', body='')
+        for i, fact in enumerate(facts):
+            Result.objects.create(assignment_id='%s-%d' % (hit.hit_id, i), hit=hit, value=json.dumps({'fact': fact}))
+        return hit
+        
+    def reduce_params(self):
+        from crowdforge import flows
+        self.patch(settings, DEBUG=True)
+        connection.queries = []
+        params = flows.get(self.problem).get_reduce_params()
+        return params, len(connection.queries)
+        
+    def test_grouped(self):
+        from crowdforge import flows
+        first = self.add_map_hit('History', ['a', 'b'])
+        self.add_map_hit('Sports', [])
+        self.add_map_hit('Food', ['c'])
+        params, few = self.reduce_params()
+        self.assertEqual(params, [{'topic': 'History', 'list': '<li>a</li><li>b</li>'}, 
+            {'topic': 'Sports', 'list': ''}, {'topic': 'Food', 'list': '<li>c</li>'}])
+        self.assertEqual(flows.get(self.problem).get_map_results(first), '<li>a</li><li>b</li>')
+        
+        for i in range(20):
+            self.add_map_hit('topic %d' % i, ['x', 'y', 'z'])
+        params, many = self.reduce_params()
+        self.assertEqual(len(params), 23)
+        self.assertEqual(few, many)
+
+class RatingTallyTest(FakeMTurkTestCase):
+    def setUp(self):
+        FakeMTurkTestCase.setUp(self)
+        self.problem.flow = FlowType.objects.get(name='VerificationFlow')
+        self.problem.partition_verify = HitType.objects.create(title='rate', description='rate', 
+            body='{{ partitions }}', keywords='rate')
+        self.problem.save()
+        partition_hit = self.make_hit('P1')
+        self.partitions = [Result.objects.create(assignment_id='P1-%d' % i, hit=partition_hit, 
+            value=json.dumps({'item1': 'topic %d' % i})) for i in range(3)]
+        
+    def vote(self, hit_id, *ratings):
+        """Submit one verification result per dict of partition index: rating"""
+        hit = Hit.objects.create(hit_id=hit_id, hit_type=self.problem.partition_verify, problem=self.problem,
+            title='rate', description='rate', body='')
+        self.conn.hits[hit_id] = (Record(MaxAssignments=str(len(ratings)), expired=False), 
+            [assignment('%s-%d' % (hit_id, n), **dict([(str(self.partitions[i].pk), str(r)) for i, r in votes.items()]))
+             for n, votes in enumerate(ratings)])
+        from crowdforge import flows
+        flows.get(self.problem).on_results_retrieved(get_snapshot(hit).save_results())
+        
+    def test_running_tally(self):
+        from crowdforge import flows
+        self.vote('V1', {0: 2, 1: 5, 2: 3}, {0: 4, 1: 5})
+        self.vote('V2', {0: 3, 1: 2, 2: 3})
+        tallies = stats.get_tallies(self.problem, self.problem.partition_verify)
+        self.assertEqual([t.partition_id for t in tallies], [p.pk for p in (self.partitions[1], self.partitions[0], self.partitions[2])])
+        self.assertEqual([(t.total, t.count) for t in tallies], [(12, 3), (9, 3), (6, 2)])
+        self.assertEqual(flows.get(self.problem).get_top_rated_partition(), ['topic 1'])
+        
+        # rebuilding from the raw results gives the same tallies
+        stats.rebuild_tallies(self.problem, self.problem.partition_verify)
+        rebuilt = stats.get_tallies(self.problem, self.problem.partition_verify)
+        self.assertEqual([(t.partition_id, t.total, t.count) for t in rebuilt], 
+            [(t.partition_id, t.total, t.count) for t in tallies])
+        
+    def test_untallied_votes_count(self):
+        from crowdforge import flows
+        self.vote('V1', {0: 4, 1: 3})
+        self.vote('V2', {1: 5}, {1: 5})
+        # as if the poller died after storing V2's results, before tallying them
+        RatingTally.objects.filter(partition=self.partitions[1]).update(total=3, total_squares=9, count=1)
+        self.assertEqual(flows.get(self.problem).get_top_rated_partition(), ['topic 1'])
+        
+    def test_no_votes(self):
+        from crowdforge import flows
+        self.vote('V1')
+        self.assertEqual(flows.get(self.problem).get_top_rated_partition(), ['topic 0'])
+        self.problem.stage = self.problem.partition_verify
+        self.problem.save()
+        flows.get(self.problem).on_stage_completed(self.problem.partition_verify)
+        self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, self.problem.mapper)
+        self.assertEqual(list(Hit.objects.filter(hit_type=self.problem.mapper).values_list('title', flat=True)),
+            [self.problem.mapper.title % {'topic': 'topic 0'}])
+        
+    def test_report_is_one_query(self):
+        for i in range(5):
+            self.vote('V%d' % i, {0: 1, 1: 2, 2: i + 1})
+        self.patch(settings, DEBUG=True)
+        connection.queries = []
+        tallies = stats.get_tallies(self.problem, self.problem.partition_verify)
+        [t.partition.hit.hit_type_id for t in tallies]
+        self.assertEqual(len(connection.queries), 1)
+        self.assertEqual(tallies[0].partition_id, self.partitions[2].pk)
+        self.assertEqual(tallies[0].count, 5)
+        
+    def test_partition_selection_ratings(self):
+        from crowdforge import flows
+        self.problem.flow = FlowType.objects.get(name='PartitionSelectionExperimentFlow')
+        self.problem.mapper = self.problem.partition_verify
+        self.problem.save()
+        self.vote('V1', {0: 2, 1: 5}, {0: 4, 1: 5}, {0: 3})
+        ratings = flows.get(self.problem).get_ratings()
+        self.assertEqual([r['partition'] for r in ratings], [['topic 1'], ['topic 0']])
+        self.assertEqual([r['respondents'] for r in ratings], [2, 3])
+        self.assertEqual(ratings[1]['rating'], 3)
+        self.assertAlmostEqual(ratings[1]['low'], 3 - 1.96 / 3 ** 0.5)
+        self.assertEqual(ratings[0]['low'], 5)
+        self.assertEqual(ratings[0]['origin'], 'original')
+
+class RatingsTest(TestCase):
+    def test_matrix_statistics(self):
+        from crowdforge.ratings import RatingMatrix
+        matrix = RatingMatrix.from_votes([('a', {1: 2, 2: 5, 3: 3}), ('b', {1: 4, 2: 5}), 
+            ('c', {1: 3, 2: 2, 3: 3}), ('d', {})])
+        self.assertEqual(matrix.ratings.shape, (4, 3))
+        self.assertEqual(list(matrix.counts()), [3, 3, 2])
+        # plain averages, not a running average divided by n + 1 at every step
+        self.assertEqual(list(matrix.means()), [3.0, 4.0, 3.0])
+        self.assertEqual(matrix.ranking(), [2, 1, 3])
+        summary = matrix.summary()
+        self.assertAlmostEqual(summary['std'][0], 1.0)
+        self.assertAlmostEqual(summary['low'][0], 3 - 1.96 / 3 ** 0.5)
+        self.assertAlmostEqual(summary['high'][0], 3 + 1.96 / 3 ** 0.5)
+        
+        agreement = matrix.agreement()
+        self.assertAlmostEqual(agreement[1], 1.0)
+        self.assertAlmostEqual(agreement[2], -1.0)
+        self.assertTrue(agreement[3] != agreement[3])
+        
+    def test_summarize_matches_matrix(self):
+        from crowdforge.ratings import RatingMatrix, summarize
+        matrix = RatingMatrix.from_votes([('a', {1: 1, 2: 4}), ('b', {1: 2, 2: 4}), ('c', {1: 5})])
+        summary = summarize([8, 8], [30, 32], [3, 2])
+        for key, values in matrix.summary().items():
+            for a, b in zip(values, summary[key]):
+                self.assertAlmostEqual(a, b)
+
+class NotifyViewTest(FakeMTurkTestCase):
+    def notify(self, events, secret_key=settings.AWS_SECRET_ACCESS_KEY, sent=None):
+        from crowdforge.notifications import build_notification
+        return self.client.get('/turk/notify/', build_notification(events, secret_key, sent))
+        
+    def test_assignment_submitted_advances_stage(self):
+        self.problem.stage = self.problem.partition
+        self.problem.save()
+        self.make_hit('H1', assignments=[assignment('A1', item1='History', item2='Sports')])
+        self.make_hit('H2')
+        
+        response = self.notify([{'EventType': 'AssignmentSubmitted', 'HITId': 'H1', 'AssignmentId': 'A1'}])
+        self.assertEqual(response.status_code, 200)
+        # only the HIT from the event was checked
+        self.assertEqual(self.conn.calls, ['GetHIT', 'GetAssignmentsForHIT'])
+        self.assertEqual(Result.objects.filter(hit__hit_id='H1').count(), 1)
+        self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, self.problem.partition)
+        
+        self.conn.hits['H2'][0].expired = True
+        self.notify([{'EventType': 'HITExpired', 'HITId': 'H2'}])
+        self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, self.problem.mapper)
+        self.assertEqual(Hit.objects.filter(hit_type=self.problem.mapper).count(), 2)
+        
+    def test_bad_signature(self):
+        self.make_hit('H1', assignments=[assignment('A1', item1='History')])
+        response = self.notify([{'EventType': 'AssignmentSubmitted', 'HITId': 'H1'}], secret_key='wrong')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.conn.calls, [])
+        
+    def test_replayed_notification(self):
+        import time
+        self.make_hit('H1', assignments=[assignment('A1', item1='History')])
+        response = self.notify([{'EventType': 'AssignmentSubmitted', 'HITId': 'H1'}], sent=time.time() - 3600)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.conn.calls, [])
+        
+    def test_verify(self):
+        from crowdforge.notifications import build_notification, verify
+        params = build_notification([], 'key', sent=1000000000)
+        self.assertTrue(verify(params, 'key', now=1000000060))
+        self.assertFalse(verify(params, 'key', now=1000000000 + 3600))
+        self.assertFalse(verify(dict(params, Signature=params['Signature'][:-1]), 'key', now=1000000000))
+        self.assertFalse(verify(dict(params, Timestamp='yesterday'), 'key', now=1000000000))
+
+class MetricsTest(FakeMTurkTestCase):
+    def setUp(self):
+        from crowdforge import metrics
+        FakeMTurkTestCase.setUp(self)
+        self.metrics = metrics
+        registry = metrics.Registry()
+        registry.descriptions = metrics.registry.descriptions
+        self.patch(metrics, registry=registry)
+        
+    def test_labelled_by_problem_and_stage(self):
+        from crowdforge.notifications import process_snapshot
+        hit = self.make_hit('H1', assignments=[assignment('A1', item1='History')])
+        process_snapshot(get_snapshot(hit))
+        registry = self.metrics.registry
+        labels = {'problem': str(self.problem.pk), 'stage': str(hit.hit_type_id)}
+        self.assertEqual(registry.get('crowdforge_mturk_calls_total', operation='get_hit', **labels), 1)
+        self.assertEqual(registry.get('crowdforge_mturk_call_seconds', operation='get_assignments', **labels), 1)
+        self.assertEqual(registry.get('crowdforge_flow_callbacks_total', callback='on_results_retrieved', **labels), 1)
+        self.assertEqual(registry.get('crowdforge_flow_callback_seconds', callback='on_hit_complete', **labels), 1)
+        self.assertTrue(registry.get('crowdforge_db_queries_total', **labels) > 0)
+        
+    def test_queries_in_other_threads(self):
+        def query():
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            connection.close()
+        thread = threading.Thread(target=query)
+        thread.start()
+        thread.join()
+        self.assertEqual(self.metrics.registry.get('crowdforge_db_queries_total', problem='', stage=''), 1)
+        
+    def test_flush_and_export(self):
+        import tempfile
+        path = tempfile.mktemp()
+        try:
+            registry = self.metrics.registry
+            registry.inc('crowdforge_mturk_calls_total', {'operation': 'get_hit'})
+            self.metrics.flush(path)
+            registry.inc('crowdforge_mturk_calls_total', {'operation': 'get_hit'}, 2)
+            registry.observe('crowdforge_flow_callback_seconds', {'callback': 'start'}, 0.2)
+            self.metrics.flush(path)
+            text = self.metrics.export(path)
+        finally:
+            os.remove(path)
+        self.assertTrue('# TYPE crowdforge_mturk_calls_total counter' in text)
+        self.assertTrue('crowdforge_mturk_calls_total{operation="get_hit"} 3' in text)
+        self.assertTrue('crowdforge_flow_callback_seconds_bucket{callback="start",le="0.1"} 0' in text)
+        self.assertTrue('crowdforge_flow_callback_seconds_bucket{callback="start",le="0.25"} 1' in text)
+        self.assertTrue('crowdforge_flow_callback_seconds_count{callback="start"} 1' in text)
+        
+    def test_view(self):
+        self.metrics.registry.inc('crowdforge_mturk_calls_total', {'operation': 'get_hit'})
+        response = self.client.get('/turk/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertTrue('crowdforge_mturk_calls_total{operation="get_hit"}' in response.content)
+
+class HitScheduleTest(TestCase):
+    def snapshot(self, pk=1, max_assignments=1, submitted=0, expiration='2100-01-01T00:00:00Z'):
+        hit = Record(pk=pk, is_active=True)
+        info = Record(MaxAssignments=str(max_assignments), Expiration=expiration)
+        return HitSnapshot(hit, info, [None] * submitted)
+        
+    def test_idle_hits_back_off(self):
+        schedule = HitSchedule(min_interval=10, max_interval=100)
+        schedule.add(1, when=1000)
+        self.assertEqual(schedule.due(now=1000), [1])
+        intervals = []
+        for i in range(5):
+            schedule.checked(self.snapshot(), [], now=1000)
+            intervals.append(schedule.next_check() - 1000)
+        self.assertEqual(intervals, [20, 40, 80, 100, 100])
+        
+        # new results reset the interval
+        schedule.checked(self.snapshot(), ['result'], now=1000)
+        self.assertEqual(schedule.next_check(), 1010)
+        
+    def test_nearly_complete_hits_stay_frequent(self):
+        schedule = HitSchedule(min_interval=10, max_interval=100)
+        schedule.add(1, when=1000)
+        for i in range(3):
+            schedule.checked(self.snapshot(max_assignments=4, submitted=3), [], now=1000)
+        self.assertEqual(schedule.next_check(), 1010)
+        
+    def test_retired_hits_are_dropped(self):
+        schedule = HitSchedule()
+        schedule.add(1)
+        snapshot = self.snapshot()
+        snapshot.hit.is_active = False
+        schedule.checked(snapshot, [])
+        self.assertEqual(len(schedule), 0)
+        self.assertEqual(schedule.next_check(), None)
+        
+class PolldTest(FakeMTurkTestCase):
+    def test_cycle(self):
+        from crowdforge.management.commands.polld import Command as PolldCommand
+        self.problem.stage = self.problem.partition
+        self.problem.save()
+        self.make_hit('H1', assignments=[assignment('A1', item1='History')])
+        schedule = HitSchedule()
+        PolldCommand().run(schedule, cycles=1)
+        
+        # the partition HIT is done and the new map HIT was scheduled
+        map_hit = Hit.objects.get(hit_type=self.problem.mapper)
+        self.assertEqual(schedule.hits.keys(), [map_hit.pk])
+        self.assertEqual(Problem.objects.get(pk=self.problem.pk).stage, self.problem.mapper)
+        
+    def test_hits_posted_out_of_order(self):
+        from crowdforge.management.commands.polld import Command as PolldCommand
+        self.problem.stage = self.problem.partition
+        self.problem.save()
+        late = self.make_hit(utils.placeholder_id())
+        early = self.make_hit('H2')
+        schedule = HitSchedule()
+        command = PolldCommand()
+        command.rescan(schedule)
+        self.assertEqual(schedule.hits.keys(), [early.pk])
+        # e.g. a parallel post_hits job posts the lower HIT afterwards
+        self.conn.hits['H1'] = self.conn.hits.pop(late.hit_id)
+        Hit.objects.filter(pk=late.pk).update(hit_id='H1')
+        command.rescan(schedule)
+        self.assertEqual(sorted(schedule.hits.keys()), [late.pk, early.pk])
+        
+    def test_unposted_hits_are_posted(self):
+        from crowdforge.management.commands.polld import Command as PolldCommand
+        self.problem.stage = self.problem.partition
+        self.problem.save()
+        hit = self.make_hit('?0:failed')
+        schedule = HitSchedule()
+        PolldCommand().rescan(schedule)
+        self.assertTrue(Hit.objects.get(pk=hit.pk).hit_id.startswith('NEW'))
+        self.assertEqual(schedule.hits.keys(), [hit.pk])
+
+class SimulatorTest(SandboxMixin, TestCase):
+    def setUp(self):
+        from crowdforge import simulator
+        self.sandbox(ConnectionPool())
+        self.patch(utils.settings, MTURK_BACKEND='crowdforge.simulator.SimulatedConnection', MTURK_POST_RETRIES=10)
+        self.addCleanup(simulator.install, None)
+        self.problem = Problem.objects.create(name='test', flow=FlowType.objects.get(name='SimpleFlow'),
+            partition=HitType.objects.get(pk=1), mapper=HitType.objects.get(pk=2), 
+            reducer=HitType.objects.get(pk=3))
+        titles = {self.problem.partition.title: {'item1': 'History', 'item2': 'Sports', 'item3': 'Food'}}
+        def answer(title, external_url, worker_id):
+            return titles.get(title, {'fact': 'fact by ' + worker_id, 'paragraph': 'text'})
+        self.answer = answer
+        self.install = simulator.install
+        
+    def run_flow(self, sim, polls=20):
+        from crowdforge.management.commands.poll import Command as PollCommand
+        for i in range(polls):
+            PollCommand().post_notifications()
+            if not Problem.objects.get(pk=self.problem.pk).is_active:
+                return i + 1
+            sim.advance(3600)
+        self.fail('flow did not finish')
+        
+    def test_simple_flow_end_to_end(self):
+        from crowdforge.simulator import SimulatedMTurk
+        sim = self.install(SimulatedMTurk(arrival_rate=1/60.0, answer=self.answer, seed=1))
+        self.run_flow(sim)
+        self.assertEqual(Hit.objects.filter(problem=self.problem, hit_type=self.problem.mapper).count(), 3)
+        self.assertEqual(Hit.objects.filter(problem=self.problem, hit_type=self.problem.reducer).count(), 3)
+        self.assertEqual(Hit.objects.filter(problem=self.problem, is_active=True).count(), 0)
+        self.assertEqual(sim.calls['CreateHIT'], 7)
+        
+    def test_survives_errors(self):
+        from crowdforge.simulator import SimulatedMTurk
+        sim = self.install(SimulatedMTurk(arrival_rate=1/60.0, answer=self.answer, seed=1, error_rate=0.2))
+        self.run_flow(sim, polls=40)
+        self.assertEqual(Hit.objects.filter(problem=self.problem, hit_type=self.problem.reducer).count(), 3)
+        
+    def test_seeded_answers(self):
+        from crowdforge.simulator import SimulatedMTurk
+        radios = ''.join(['<input type="radio" name="r%d" value="%d" />' % (i, v) for i in range(20) for v in range(5)])
+        hit = Hit.objects.create(hit_id='S1', hit_type=self.problem.partition, problem=self.problem,
+            title='rate', description='rate', body=radios)
+        answers = [SimulatedMTurk(seed=1).answer('rate', '/turk/hit/%d/' % hit.pk, 'W1') for i in range(2)]
+        self.assertEqual(answers[0], answers[1])
+        self.assertEqual(len(answers[0]), 20)
+        
+    def test_benchmark(self):
+        from crowdforge.management.commands.benchmark import Command as BenchmarkCommand
+        options = {'problems': 2, 'flow': 'SimpleFlow', 'partition_size': 3, 'assignments': 2, 'workers': 1,
+            'step': 3600, 'max_cycles': 20, 'arrival_rate': 1/60.0, 'error_rate': 0.0, 'seed': 1}
+        # only the benchmark's own problems
+        self.problem.delete()
+        report = BenchmarkCommand().run(options)
+        self.assertEqual(report['finished'], 2)
+        # a partition, 3 map and 3 reduce HITs per problem
+        self.assertEqual(report['hits'], 14)
+        self.assertEqual(report['mturk_calls']['CreateHIT'], 14)
+        self.assertEqual(sorted(report['stage_transitions']), ['map -> reduce', 'partition -> map', 'reduce -> end'])
+        self.assertEqual(report['mturk_calls_per_cycle']['count'], report['cycles'])
+
+    def test_benchmark_pipelined(self):
+        from crowdforge.management.commands.benchmark import Command as BenchmarkCommand
+        options = {'problems': 2, 'flow': 'PipelinedFlow', 'partition_size': 3, 'assignments': 2, 'workers': 1,
+            'step': 3600, 'max_cycles': 20, 'arrival_rate': 1/60.0, 'error_rate': 0.0, 'seed': 1}
+        self.problem.delete()
+        report = BenchmarkCommand().run(options)
+        self.assertEqual(report['finished'], 2)
+        self.assertEqual(report['hits'], 14)
+        self.assertEqual(report['options']['flow'], 'PipelinedFlow')
@@ -4,4 +4,6 @@ urlpatterns = patterns('crowdforge.views',
     (r'^hit/(?P<id>\d+)/$', 'hit'),
     (r'^problem/(?P<id>\d+)/$', 'problem'),
     (r'^result/(?P<id>\d+)/$', 'result'),
+    (r'^notify/$', 'notify'),
+    (r'^metrics/$', 'metrics'),
 )
@@ -1,93 +1,534 @@
 from boto.mturk.connection import MTurkConnection
+from boto.exception import BotoServerError
 from boto.mturk.question import ExternalQuestion
 from crowdforge.models import Hit, Result
+from crowdforge import metrics, stats
+from crowdforge.renderers import get_renderer
 
+from contextlib import contextmanager
+from django.db import connection, transaction, IntegrityError
+from django.core.urlresolvers import reverse
+from django.db.models import AutoField
 from django.utils import simplejson as json
+from django.utils.importlib import import_module
+from multiprocessing.pool import ThreadPool
+import errno
+import logging
+import Queue
+import socket
+import threading
+import time
+import uuid
 import settings
 
+class ConnectionPool(object):
+    """
+    Per-process pool of MTurk connections.
+    
+    Each MTurkConnection keeps its HTTP connection alive between requests, so
+    handing the same connection objects out again avoids a new handshake for
+    every call. Keeps track of how many connections were opened vs. reused.
+    """
+    def __init__(self, size=None):
+        self.size = size or getattr(settings, 'MTURK_POOL_SIZE', 4)
+        self.idle = Queue.LifoQueue(self.size)
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+        
+    def new_connection(self):
+        backend = get_backend()
+        return backend(aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                      aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                      host=settings.AWS_HOST)
+        
+    def acquire(self):
+        """Get an idle connection from the pool, opening a new one if needed"""
+        try:
+            conn = self.idle.get_nowait()
+        except Queue.Empty:
+            conn = metrics.InstrumentedConnection(self.new_connection())
+            with self.lock:
+                self.opened += 1
+            return conn
+        with self.lock:
+            self.reused += 1
+        return conn
+        
+    def release(self, conn):
+        """Return a connection to the pool, closing it if the pool is full"""
+        try:
+            self.idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+            
+    def ensure_size(self, size):
+        """Grow the pool so that it can keep `size` connections open"""
+        if size > self.size:
+            self.size = self.idle.maxsize = size
+            
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+            
+    def stats(self):
+        return {'opened': self.opened, 'reused': self.reused, 'idle': self.idle.qsize()}
+        
+# shared by everything that talks to AMT in this process
+connection_pool = ConnectionPool()
+
+def get_backend():
+    """
+    The connection class used to talk to AMT, MTurkConnection unless
+    settings.MTURK_BACKEND names another one (e.g. the simulator)
+    """
+    path = getattr(settings, 'MTURK_BACKEND', None)
+    if not path:
+        return MTurkConnection
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
 def create_hit(problem, hit_type, params={}):
     """Utility method for creating a new HIT on AMT"""
-    hit = Hit(hit_id='?', hit_type=hit_type, problem=problem, params=json.dumps(params),
-            title=hit_type.title%params, description=hit_type.description%params, body=hit_type.body%params)
-    hit.save()
+    return create_hits(problem, hit_type, [params])[0]
+    
+def create_hits(problem, hit_type, params_list, workers=None):
+    """
+    Create a HIT on AMT for each set of params in params_list.
+    
+    All Hit rows are inserted with a single bulk write, posted to AMT from a
+    bounded thread pool and then updated with their HIT IDs in one
+    transaction. Returns the Hit objects in the same order as params_list.
+    
+    Inside a deferred_posting() block the rows are only inserted; posting
+    them is up to the caller.
+    """
+    # rows get a unique placeholder ID until AMT has assigned the real one
+    renderer = get_renderer(hit_type)
+    hits = []
+    for params in params_list:
+        title, description, body = renderer.render(params)
+        hits.append(Hit(hit_id=placeholder_id(), hit_type=hit_type, problem=problem, 
+            params=json.dumps(params), title=title, description=description, body=body))
+    if not hits:
+        return hits
+    bulk_insert(Hit, hits)
+    stats.record_hits_created(problem, len(hits))
+    
+    # read back the primary keys of the new rows
+    ids = {}
+    for placeholders in chunks([hit.hit_id for hit in hits]):
+        ids.update(Hit.objects.filter(hit_id__in=placeholders).values_list('hit_id', 'id'))
+    for hit in hits:
+        hit.id = ids[hit.hit_id]
+    
+    deferred = getattr(_posting, 'hits', None)
+    if deferred is not None:
+        deferred.extend(hits)
+        return hits
+    post_hits(hits, workers)
+    return hits
+    
+# the HITs created in the current thread's deferred_posting() block
+_posting = threading.local()
 
-    # post a HIT on Mechanical Turk using boto
-    q = ExternalQuestion(external_url=settings.URL_ROOT + hit.get_absolute_url(), frame_height=800)
-    conn = MTurkConnection(aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                          aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                          host=settings.AWS_HOST)
+@contextmanager
+def deferred_posting():
+    """
+    Collect the HITs created inside the block instead of posting them, e.g.
+    so that they're only posted once the transaction creating them commits.
+    Yields the list they're added to; pass it to post_hits() afterwards.
+    """
+    old = getattr(_posting, 'hits', None)
+    _posting.hits = []
+    try:
+        yield _posting.hits
+    finally:
+        _posting.hits = old
+        
+def placeholder_id():
+    """A unique HIT ID for a row that isn't posted yet, recording when it was made"""
+    return '?%d:%s' % (time.time(), uuid.uuid4().hex)
+    
+def placeholder_age(hit_id):
+    """Seconds since the placeholder HIT ID was made, or None if it doesn't say"""
+    if ':' not in hit_id:
+        return None
+    return time.time() - int(hit_id[1:].split(':', 1)[0])
+        
+def post_pending_hits(hits, workers=None, min_age=0):
+    """
+    Post the active HITs among `hits` (a queryset) that were never posted,
+    e.g. after a crash or a failed post, leaving the ones that got their
+    placeholder less than `min_age` seconds ago.
+    """
+    # with their HitType, which the posting threads need
+    pending = list(hits.filter(is_active=True, hit_id__startswith='?').select_related('hit_type')
+        .defer(*Hit.PAYLOADS).order_by('id'))
+    # take each HIT by giving it a new placeholder, so that two pollers never
+    # post the same one and the next one leaves it alone for a while
+    claimed = []
+    for hit in pending:
+        age = placeholder_age(hit.hit_id)
+        if age is not None and age < min_age:
+            continue
+        hit_id = placeholder_id()
+        if Hit.objects.filter(pk=hit.pk, hit_id=hit.hit_id).update(hit_id=hit_id):
+            hit.hit_id = hit_id
+            claimed.append(hit)
+    if claimed:
+        metrics.event('post_pending', hits=len(claimed))
+        post_hits(claimed, workers)
+    return claimed
+    
+def post_hits(hits, workers=None):
+    """
+    Post the inserted HITs on AMT and save their HIT IDs. Raises the first
+    error; the HITs that certainly weren't created keep their placeholder
+    until they're posted again by post_pending_hits(), the others are
+    retired.
+    """
+    if not hits:
+        return
+    workers = workers or getattr(settings, 'MTURK_POST_WORKERS', 8)
+    # post the HITs on Mechanical Turk; only the network calls run in the pool
+    questions = [ExternalQuestion(external_url=settings.URL_ROOT + hit.get_absolute_url(), frame_height=800) 
+        for hit in hits]
+    if len(hits) == 1:
+        posted = [try_post_hit(hits[0], questions[0])]
+    else:
+        pool = ThreadPool(min(workers, len(hits)))
+        try:
+            posted = pool.map(lambda args: try_post_hit(*args), zip(hits, questions))
+        finally:
+            pool.terminate()
+    
+    # set the new HIT IDs for the rows that were posted
+    save_hit_ids([(hit, hit_id) for hit, hit_id, error in posted if not error])
+    
+    # a HIT whose CreateHIT call may have gone through can't be posted again
+    # without risking a second paid HIT, so it's dropped instead
+    for hit, hit_id, error in posted:
+        if error and not was_not_created(error):
+            metrics.event('post_unknown', logging.ERROR, hit=hit.pk, error=error)
+            retire_hit(hit)
+    
+    errors = [error for hit, hit_id, error in posted if error]
+    if errors:
+        raise errors[0]
+    
+class PostRejected(Exception):
+    """AMT answered CreateHIT, saying that the request wasn't valid"""
+    
+# AWS error codes of requests that were turned away without being run
+THROTTLED = ('ServiceUnavailable', 'AWS.ServiceUnavailable', 'Throttling', 'RequestThrottled')
 
+def is_throttled(error):
+    """Whether the request failed before it got to AMT or AMT turned it away, so it's safe to send again"""
+    if isinstance(error, socket.gaierror):
+        return True
+    if isinstance(error, socket.error) and not isinstance(error, socket.timeout):
+        return error.errno == errno.ECONNREFUSED
+    if isinstance(error, BotoServerError):
+        return error.status == 503 or getattr(error, 'error_code', None) in THROTTLED
+    return False
+    
+def was_not_created(error):
+    """Whether the error of a CreateHIT call shows that no HIT was created"""
+    return isinstance(error, PostRejected) or is_throttled(error)
+    
+def post_hit(hit, question):
+    """
+    Post the HIT on AMT and return its new HIT ID. CreateHIT isn't
+    idempotent, so it's only sent again (up to MTURK_POST_RETRIES times)
+    after errors showing that it wasn't run, never after e.g. a timeout.
+    """
+    hit_type = hit.hit_type
     # remove commas from the keywords if they exist
     keywords=[k.replace(',', '') for k in hit_type.keywords.split()]
-    create_hit_rs = conn.create_hit(question=q, lifetime=hit_type.lifetime, max_assignments=hit_type.max_assignments,
-        keywords=keywords, reward=hit_type.payment, duration=hit_type.duration, approval_delay=hit_type.approval_delay, 
-        title=hit.title, description=hit.description, annotation=`hit_type`)
-    assert(create_hit_rs.status == True)
+    retries = getattr(settings, 'MTURK_POST_RETRIES', 2)
+    with metrics.context(hit.problem_id, hit.hit_type_id), connection_pool.connection() as conn:
+        for attempt in range(retries + 1):
+            try:
+                create_hit_rs = conn.create_hit(question=question, lifetime=hit_type.lifetime, max_assignments=hit_type.max_assignments,
+                    keywords=keywords, reward=hit_type.payment, duration=hit_type.duration, approval_delay=hit_type.approval_delay, 
+                    title=hit.title, description=hit.description, annotation=`hit_type`)
+                break
+            except Exception, e:
+                if attempt == retries or not is_throttled(e):
+                    raise
+                metrics.event('post_retry', logging.WARNING, hit=hit.pk, attempt=attempt + 1, error=e)
+        if create_hit_rs.status != True:
+            raise PostRejected(getattr(create_hit_rs, 'errors', None))
+        try:
+            register_notifications(conn, getattr(create_hit_rs, 'HITTypeId', None))
+        except Exception, e:
+            # the HIT is posted either way; polling still picks up its results
+            metrics.event('notifications_failed', logging.WARNING, hit=hit.pk, error=e)
+    return create_hit_rs.HITId
+    
+# AMT HIT types that we've already asked for notifications about
+notifying_hit_types = set()
+
+def register_notifications(conn, hit_type_id):
+    """
+    Ask AMT to send REST notifications about HITs of this AMT HIT type to the
+    notify view. Only done when MTURK_NOTIFICATIONS is on.
+    """
+    if not getattr(settings, 'MTURK_NOTIFICATIONS', False) or not hit_type_id:
+        return
+    if hit_type_id in notifying_hit_types:
+        return
+    url = settings.URL_ROOT + reverse('crowdforge.views.notify')
+    conn.set_rest_notification(str(hit_type_id), url, event_types=['AssignmentSubmitted', 'HITExpired'])
+    notifying_hit_types.add(hit_type_id)
+    
+def try_post_hit(hit, question):
+    """Post the HIT, returning (hit, HIT ID, None), or (hit, None, error) if it failed"""
+    try:
+        return hit, post_hit(hit, question), None
+    except Exception, e:
+        metrics.event('post_failed', logging.WARNING, hit=hit.pk, error=e)
+        return hit, None, e
+        
+@transaction.commit_on_success
+def save_hit_ids(posted):
+    for hit, hit_id in posted:
+        hit.hit_id = hit_id
+        Hit.objects.filter(pk=hit.pk).update(hit_id=hit_id)
+        
+def bulk_insert(model, objects):
+    """Insert all of the objects with one executemany. Primary keys are not set."""
+    fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table), 
+        ', '.join([qn(f.column) for f in fields]), ', '.join(['%s'] * len(fields)))
+    rows = [[f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields] 
+        for obj in objects]
+    connection.cursor().executemany(sql, rows)
+    transaction.commit_unless_managed()
+    
+def chunks(items, size=500):
+    """Split items into lists that are small enough for an IN clause"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-    # set the new HIT ID to be the hit_id for the new row.
-    hit.hit_id = create_hit_rs.HITId
-    hit.save()
+# the largest page of assignments AMT returns
+ASSIGNMENTS_PAGE_SIZE = 100
 
-    return hit
+def get_assignments(conn, hit):
+    """
+    Get the HIT's assignments that may not have been seen yet, oldest first,
+    going through every page. Returns (assignments, submitted), where
+    submitted is the number of assignments the HIT has in total.
     
+    AMT sorts the assignments by submit time, so the ones before
+    hit.assignments_seen are already stored and the pages that only hold
+    those are skipped. The page holding the first new one is fetched
+    whole; save_results skips the known assignments on it.
+    """
+    page_number = hit.assignments_seen / ASSIGNMENTS_PAGE_SIZE + 1
+    assignments = []
+    while True:
+        page = conn.get_assignments(hit.hit_id, sort_by='SubmitTime', sort_direction='Ascending',
+            page_size=ASSIGNMENTS_PAGE_SIZE, page_number=page_number)
+        assignments.extend(page)
+        total = getattr(page, 'TotalNumResults', None)
+        if total is not None:
+            submitted = int(total)
+            if page_number * ASSIGNMENTS_PAGE_SIZE >= submitted:
+                break
+        elif len(page) < ASSIGNMENTS_PAGE_SIZE:
+            submitted = (page_number - 1) * ASSIGNMENTS_PAGE_SIZE + len(page)
+            break
+        page_number += 1
+    return assignments, submitted
+
+def record_assignments_seen(hit, submitted):
+    """Move the HIT's high-water mark up to `submitted` once their results are stored"""
+    if submitted > hit.assignments_seen:
+        Hit.objects.filter(pk=hit.pk, assignments_seen__lt=submitted).update(assignments_seen=submitted)
+        hit.assignments_seen = submitted
+
 def fetch_results(hit):
     """Poll AMT for new results for the specified HIT"""
-    conn = MTurkConnection(aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                          aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                          host=settings.AWS_HOST)
     # using the HIT ID, check results
-    results = []
-    assignments = conn.get_assignments(hit.hit_id)
+    with connection_pool.connection() as conn:
+        assignments, submitted = get_assignments(conn, hit)
+    results = save_results(hit, assignments)
+    record_assignments_seen(hit, submitted)
+    return results
+    
+def save_results(hit, assignments):
+    """
+    Store a Result for every assignment that hasn't been seen before.
+    
+    Known assignments are looked up with one IN query and the new results are
+    inserted together. Only the results inserted by this call are returned, so
+    when two pollers race on the same HIT each result is handed to the flow
+    exactly once.
+    """
+    existing = existing_assignment_ids([ass.AssignmentId for ass in assignments])
+    new_results = []
     # go through the assignments
     for ass in assignments:
         # if there's already a result for this assignment, skip it
-        if Result.objects.filter(assignment_id=ass.AssignmentId):
+        if ass.AssignmentId in existing:
             continue
+        existing.add(ass.AssignmentId)
         # parse out the result
         data = {}
         for answer in ass.answers[0]:
             data[answer.QuestionIdentifier] = answer.FreeText
 
         # create new Result objects for each of them
-        result = Result(assignment_id=ass.AssignmentId, hit=hit, value=json.dumps(data))
-        result.save()
-        results.append(result)
-
+        new_results.append(Result(assignment_id=ass.AssignmentId, hit=hit, value=json.dumps(data)))
+        
+    assignment_ids = insert_results(new_results)
+    # read the new rows back to get their primary keys
+    results = []
+    for ids in chunks(assignment_ids):
+        results.extend(Result.objects.filter(assignment_id__in=ids))
+    results.sort(key=lambda result: result.id)
+    for result in results:
+        result.hit = hit
+    
+    stats.record_results(hit, results)
     return results
+    
+def existing_assignment_ids(assignment_ids):
+    existing = set()
+    for ids in chunks(assignment_ids):
+        existing.update(Result.objects.filter(assignment_id__in=ids).values_list('assignment_id', flat=True))
+    return existing
+    
+@transaction.commit_on_success
+def insert_results(results):
+    """
+    Insert the results in one transaction and return the assignment IDs that
+    were inserted. The unique assignment_id makes the insert fail if another
+    poller got there first; in that case the rows it stored are dropped and
+    the rest is inserted again.
+    """
+    while results:
+        try:
+            bulk_insert(Result, results)
+        except IntegrityError, e:
+            transaction.rollback()
+            taken = existing_assignment_ids([r.assignment_id for r in results])
+            if not taken:
+                raise e
+            results = [r for r in results if r.assignment_id not in taken]
+        else:
+            break
+    return [r.assignment_id for r in results]
 
 def is_expired(hit):
     """Poll AMT to check if the specified HIT is expired"""
-    conn = MTurkConnection(aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                          aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                          host=settings.AWS_HOST)
-    result = conn.get_hit(hit.hit_id)[0]
-    if hasattr(result, 'Error'):
-        print "Something went wrong! %s is an invalid HIT" % str(hit)
+    with connection_pool.connection() as conn:
+        info = conn.get_hit(hit.hit_id)[0]
+    return check_expired(hit, info)
+
+def is_complete(hit):
+    """Poll AMT to check if all instances of the specified HIT have been completed"""
+    with connection_pool.connection() as conn:
+        info = conn.get_hit(hit.hit_id)[0]
+        if hasattr(info, 'Error'):
+            return check_complete(hit, info, 0)
+        assignments, submitted = get_assignments(conn, hit)
+    return check_complete(hit, info, submitted)
+    
+def retire_hit(hit):
+    """
+    Deactivate the HIT, writing only is_active so that deferred payloads
+    aren't loaded. Returns whether this call retired it; when a poller and
+    the notify view handle the same HIT at once, only one of them does.
+    """
+    hit.is_active = False
+    if not Hit.objects.filter(pk=hit.pk, is_active=True).update(is_active=False):
+        return False
+    stats.record_hit_retired(hit)
+    return True
+    
+def check_expired(hit, info):
+    """
+    Deactivate the HIT if the AMT HIT info says it has expired. Only True for
+    the caller that deactivated it (or if the HIT is invalid).
+    """
+    if hasattr(info, 'Error'):
+        metrics.event('invalid_hit', logging.WARNING, hit=hit.pk, hit_id=hit.hit_id)
         return True 
-    assignments = conn.get_assignments(hit.hit_id)
 
-    if result.expired:
-        hit.is_active = False
-        hit.save()
-        return True
+    if info.expired:
+        return retire_hit(hit)
 
     return False
-
-def is_complete(hit):
-    """Poll AMT to check if all instances of the specified HIT have been completed"""
-    conn = MTurkConnection(aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                          aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                          host=settings.AWS_HOST)
-    result = conn.get_hit(hit.hit_id)[0]
-    if hasattr(result, 'Error'):
-        print "Something went wrong! %s is an invalid HIT" % str(hit)
+    
+def check_complete(hit, info, submitted):
+    """
+    Deactivate the HIT if all of its assignments have been submitted. Only
+    True for the caller that deactivated it (or if the HIT is invalid).
+    """
+    if hasattr(info, 'Error'):
+        metrics.event('invalid_hit', logging.WARNING, hit=hit.pk, hit_id=hit.hit_id)
         return True 
-    assignments = conn.get_assignments(hit.hit_id)
 
-    if int(result.MaxAssignments) == len(assignments):
-        hit.is_active = False
-        hit.save()
-        return True
+    if submitted >= int(info.MaxAssignments):
+        return retire_hit(hit)
 
     return False
+    
+class HitSnapshot(object):
+    """
+    The state of a HIT on AMT at one point in time.
+    
+    Fetching a snapshot costs one GetHIT call and one GetAssignmentsForHIT
+    call per page of assignments not seen yet (usually one); new results,
+    expiry and completion are all derived from it without going back to
+    AMT. Fetching does not touch the database.
+    
+    assignments only holds the ones that may be new, submitted counts all.
+    """
+    def __init__(self, hit, info, assignments, submitted=None):
+        self.hit = hit
+        self.info = info
+        self.assignments = assignments
+        if submitted is None:
+            submitted = len(assignments)
+        self.submitted = submitted
+        
+    @classmethod
+    def fetch(cls, hit):
+        with metrics.context(hit.problem_id, hit.hit_type_id), connection_pool.connection() as conn:
+            info = conn.get_hit(hit.hit_id)[0]
+            assignments, submitted = [], 0
+            if not hasattr(info, 'Error'):
+                assignments, submitted = get_assignments(conn, hit)
+        return cls(hit, info, assignments, submitted)
+        
+    def save_results(self):
+        results = save_results(self.hit, self.assignments)
+        record_assignments_seen(self.hit, self.submitted)
+        return results
+        
+    def is_expired(self):
+        return check_expired(self.hit, self.info)
+        
+    def is_complete(self):
+        return check_complete(self.hit, self.info, self.submitted)
+        
+def get_snapshot(hit):
+    """Poll AMT once for the HIT metadata and all of its assignments"""
+    return HitSnapshot.fetch(hit)
 
+def try_get_snapshot(hit):
+    """Like get_snapshot, but returns None if talking to AMT failed"""
+    try:
+        return get_snapshot(hit)
+    except Exception, e:
+        metrics.event('check_failed', logging.WARNING, hit=hit.pk, hit_id=hit.hit_id, error=e)
+        return None
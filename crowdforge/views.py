@@ -1,12 +1,24 @@
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import Http404
-from django.utils import simplejson as json
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 
 from models import Hit, Problem, Result
+from stats import get_stats, get_stage_stats
+from metrics import export
+from renderers import get_page, fill_page, page_etag
 import settings
 
-def hit(request, id):
-    h = get_object_or_404(Hit, pk=id)
+def get_hit_page(request, id):
+    # the page is rendered once per HIT and cached, see crowdforge.renderers
+    if not hasattr(request, 'hit_page'):
+        try:
+            request.hit_page = get_page(id)
+        except Hit.DoesNotExist:
+            raise Http404
+    return request.hit_page
+    
+def get_hit_params(request):
     # see if there's a turkSubmitTo parameter in the request GET:
     # action = 'http://www.mturk.com/mturk/externalSubmit'
     action = 'http://workersandbox.mturk.com/mturk/externalSubmit'
@@ -16,36 +28,76 @@ def hit(request, id):
     assignment_id = None
     if request.GET.has_key('assignmentId'):
         assignment_id = request.GET['assignmentId']
-        
-    return render_to_response('hit.html', 
-        {'title': h.title, 'body': h.body, 'assignment_id': assignment_id, 'action': action})
+    return action, assignment_id
+    
+def hit_etag(request, id):
+    return page_etag(get_hit_page(request, id), *get_hit_params(request))
+    
+def hit_last_modified(request, id):
+    return get_hit_page(request, id)['modified']
+
+@condition(etag_func=hit_etag, last_modified_func=hit_last_modified)
+def hit(request, id):
+    action, assignment_id = get_hit_params(request)
+    response = HttpResponse(fill_page(get_hit_page(request, id)['page'], action, assignment_id))
+    # HIT pages don't change, and the parts that do vary are in the URL
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'HIT_PAGE_MAX_AGE', 60*60))
+    return response
         
 def problem(request, id):
-    p = get_object_or_404(Problem, pk=id)
-    
-    # get all HITs of a certain type associated with this problem
-    partition_hits = p.partition.hit_set.filter(problem=p)
-    partition2_hits = p.partition2 and p.partition2.hit_set.filter(problem=p) or None
-    map_hits = p.mapper.hit_set.filter(problem=p)
-    reduce_hits = p.reducer and p.reducer.hit_set.filter(problem=p) or None
-    
-    # get total number of HITs taken and total cost
-    total_results = Result.objects.filter(hit__problem=p)
-    number = len(total_results)
-    cost = sum([result.hit.hit_type.payment for result in total_results])
-    
-    if number >= 2:
-        # get the first and last created HITs here to see how long the whole thing took
-        first = total_results.order_by('created')[0].created
-        last = total_results.order_by('created').reverse()[0].created
-        duration = last - first
-    else:
-        duration = None
+    p = get_object_or_404(Problem.objects.select_related('partition', 'partition2', 'mapper', 'reducer'), pk=id)
+    
+    # get all HITs associated with this problem along with their results,
+    # in one query each, and group them by HIT type
+    hits = Hit.objects.filter(problem=p).select_related('hit_type').defer(*Hit.PAYLOADS).order_by('id')
+    results = {}
+    for r in Result.objects.filter(hit__problem=p).order_by('id'):
+        results.setdefault(r.hit_id, []).append(r)
+    hits_by_type = {}
+    for h in hits:
+        h.results = results.get(h.id, [])
+        hits_by_type.setdefault(h.hit_type_id, []).append(h)
+    
+    partition_hits = hits_by_type.get(p.partition_id, [])
+    partition2_hits = p.partition2_id and hits_by_type.get(p.partition2_id) or None
+    map_hits = hits_by_type.get(p.mapper_id, [])
+    reduce_hits = p.reducer_id and hits_by_type.get(p.reducer_id) or None
+    
+    # get total number of HITs taken, total cost and duration from the rollup
+    stats = get_stats(p)
+    stage_stats = get_stage_stats(p)
+    stages = [(h, stage_stats.get(h.id)) for h in [p.partition, p.partition2, p.mapper, p.reducer] if h]
     
     return render_to_response('problem.html', {'problem': p, 
             'partition': partition_hits, 'partition2': partition2_hits, 
-            'map': map_hits, 'reduce': reduce_hits, 'number': number, 'cost': cost, 'duration': duration})
+            'map': map_hits, 'reduce': reduce_hits, 'number': stats.result_count, 'cost': stats.cost, 
+            'duration': stats.get_duration(), 'active_hits': stats.active_hits, 'stages': stages})
             
 def result(request, id):
     r = get_object_or_404(Result, pk=id)
-    return render_to_response('result.html', {'result': r, 'value_dict': json.loads(r.value)})
\ No newline at end of file
+    return render_to_response('result.html', {'result': r, 'value_dict': r.data})
+            
+def notify(request):
+    """
+    Endpoint for AMT REST notifications (AssignmentSubmitted, HITExpired, ...).
+    Checks just the HITs named in the events right away, so results and stage
+    transitions don't have to wait for the next poll.
+    """
+    # imported here since the flows register themselves in the database on import
+    from notifications import verify, parse_events, process_hits
+    
+    params = dict(request.REQUEST.items())
+    if params.get('method') != 'Notify':
+        return HttpResponseBadRequest('not an AMT notification')
+    if not verify(params, settings.AWS_SECRET_ACCESS_KEY):
+        return HttpResponseForbidden('bad signature')
+    
+    hit_ids = set([event['HITId'] for event in parse_events(params) if event.get('HITId')])
+    hits = Hit.objects.filter(hit_id__in=hit_ids, is_active=True).select_related('problem__flow') \
+        .defer(*Hit.PAYLOADS).order_by('problem', 'id')
+    process_hits(hits)
+    return HttpResponse('OK', mimetype='text/plain')
+    
+def metrics(request):
+    """Counters and latency histograms in the Prometheus text format"""
+    return HttpResponse(export(), mimetype='text/plain; version=0.0.4')
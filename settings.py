@@ -1,4 +1,5 @@
 # Django settings for crowdforge project.
+import os
 
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
@@ -18,6 +19,37 @@ AWS_HOST = 'mechanicalturk.sandbox.amazonaws.com'
 # AWS_HOST = 'mechanicalturk.amazonaws.com'
 # TODO: Update with your externally accessible URL ROOT
 URL_ROOT = 'http://localhost:8000'
+# Number of MTurk connections kept open (and reused) per process
+MTURK_POOL_SIZE = 4
+# Number of HITs posted to MTurk concurrently when a stage fans out
+MTURK_POST_WORKERS = 8
+# Number of times a HIT posting that MTurk turned away (e.g. throttled) is retried
+MTURK_POST_RETRIES = 2
+# HITs whose posting failed are posted again by poll after this many seconds
+MTURK_POST_PENDING_SECONDS = 10*60
+# Have MTurk call URL_ROOT/turk/notify/ when assignments are submitted or
+# HITs expire, instead of waiting for the next poll (URL_ROOT must be public)
+MTURK_NOTIFICATIONS = False
+# Notifications signed more than this many seconds ago (or ahead) are rejected
+MTURK_NOTIFICATION_MAX_AGE = 15*60
+# Connection class used to talk to MTurk. Use the in-process simulator to
+# run flows offline, configured with the MTURK_SIMULATOR keyword arguments
+# (see crowdforge/simulator.py)
+MTURK_BACKEND = 'boto.mturk.connection.MTurkConnection'
+# MTURK_BACKEND = 'crowdforge.simulator.SimulatedConnection'
+# MTURK_SIMULATOR = {'arrival_rate': 1/60.0, 'latency': (30, 300), 'error_rate': 0.01}
+# poll and polld add their metrics to this file for the metrics view
+METRICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.json')
+# How long a sharded poller (poll --shard) holds on to its problems; another
+# poller takes over this long after it stops (see crowdforge/leases.py)
+POLL_LEASE_SECONDS = 5*60
+# Queue stage transitions and HIT postings as jobs for `manage.py work`
+# instead of running them inside poll (see crowdforge/jobs.py)
+FLOW_JOBS = False
+JOB_POST_BATCH = 50
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_SECONDS = 60
+JOB_LEASE_SECONDS = 10*60
 
 MANAGERS = ADMINS
 
@@ -68,6 +100,25 @@ TEMPLATE_LOADERS = (
     'django.template.loaders.app_directories.load_template_source',
 #     'django.template.loaders.eggs.load_template_source',
 )
+if not DEBUG:
+    # parse each template only once per process
+    TEMPLATE_LOADERS = (('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),)
+
+# rendered HIT pages are cached by Hit id; use memcached to share them
+# between web server processes
+CACHE_BACKEND = 'locmem://'
+HIT_PAGE_CACHE_SECONDS = 60*60*24
+# how long browsers and proxies may reuse a HIT page without asking again
+HIT_PAGE_MAX_AGE = 60*60
+
+# HIT bodies and params and result values longer than BLOB_INLINE_LIMIT
+# characters are stored as files under BLOB_ROOT, see crowdforge/blobstore.py
+BLOB_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blobs')
+BLOB_INLINE_LIMIT = 1024
+# Number of parsed result values kept in memory per process, and the module
+# whose loads() parses them, e.g. 'ujson' (see crowdforge/codec.py)
+RESULT_CACHE_SIZE = 10000
+JSON_CODEC = 'django.utils.simplejson'
 
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',